@@ -0,0 +1,229 @@
+"""
+Adaptive admission control and load shedding.
+
+Scale-up takes at least 15 s (k8s/hpa.yaml), so a burst that arrives faster
+than that queues in uvicorn and in the DB pool and raises latency for
+everyone. This ASGI middleware watches event-loop lag, in-flight requests and
+DB pool wait time and, once they pass their limits, rejects low-priority work
+early with 503 + Retry-After instead of letting it queue.
+
+Priorities:
+    critical  /borrow, /return, /health, /metrics - never shed
+    low       expensive list endpoints - shed first, and rate limited per user
+              (anonymous callers per client IP only if ADMISSION_TRUST_CLIENT_IP)
+    normal    everything else - shed only when overloaded
+"""
+import json
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from jose import JWTError, jwt
+from prometheus_client import Counter, Gauge
+
+from .auth import ALGORITHM, SECRET_KEY
+from .runtime import loop_lag_monitor, pool_wait_tracker
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_LOOP_LAG_MS = float(os.getenv("ADMISSION_MAX_LOOP_LAG_MS", "100"))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200"))
+ADMISSION_MAX_POOL_WAIT_MS = float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "100"))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+# Per-user token bucket for list endpoints: sustained rate and burst size
+LIST_RATE_PER_SECOND = float(os.getenv("LIST_RATE_PER_SECOND", "5"))
+LIST_BURST = float(os.getenv("LIST_BURST", "20"))
+# Rate limit anonymous list requests per client IP. Only enable this when
+# uvicorn runs with --proxy-headers --forwarded-allow-ips=<ingress addresses>;
+# otherwise every anonymous request behind the ingress has the ingress pod's
+# address and they would all share one bucket.
+ADMISSION_TRUST_CLIENT_IP = os.getenv("ADMISSION_TRUST_CLIENT_IP", "false").lower() == "true"
+
+CRITICAL_PATHS = ('/borrow', '/return', '/health', '/metrics')
+
+# (method, path prefix) of endpoints that scan whole tables
+EXPENSIVE_LIST_ENDPOINTS = (
+    ('GET', '/books/'),
+    ('GET', '/me/transactions'),
+    ('GET', '/admin/transactions'),
+)
+
+# Controller states, exported as lms_admission_state
+STATE_OK = 0
+STATE_DEGRADED = 1
+STATE_OVERLOADED = 2
+
+admission_shed_counter = Counter(
+    'lms_admission_shed_total',
+    'Requests rejected by the admission controller',
+    ['priority', 'reason']
+)
+
+admission_state = Gauge(
+    'lms_admission_state',
+    'Admission controller state: 0 ok, 1 degraded (shedding low priority), 2 overloaded (shedding normal priority)'
+)
+
+admission_in_flight = Gauge(
+    'lms_admission_in_flight_requests',
+    'HTTP requests currently being handled'
+)
+
+
+def classify(method: str, path: str) -> str:
+    if path.startswith(CRITICAL_PATHS):
+        return "critical"
+    for list_method, prefix in EXPENSIVE_LIST_ENDPOINTS:
+        # exact list path only: /books/ is expensive, /books/{id} is not
+        if method == list_method and path == prefix:
+            return "low"
+    return "normal"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, burst: float) -> float:
+        """Take one token. Returns 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_loop_lag_ms: float = ADMISSION_MAX_LOOP_LAG_MS,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_pool_wait_ms: float = ADMISSION_MAX_POOL_WAIT_MS,
+        list_rate: float = LIST_RATE_PER_SECOND,
+        list_burst: float = LIST_BURST,
+    ):
+        self.max_loop_lag = max_loop_lag_ms / 1000
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait_ms / 1000
+        self.list_rate = list_rate
+        self.list_burst = list_burst
+        self.in_flight = 0
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def state(self) -> Tuple[int, str]:
+        """Return (state, reason). Each signal over its limit degrades; over twice its limit overloads."""
+        ratios = (
+            (loop_lag_monitor.lag / self.max_loop_lag, "loop_lag"),
+            (self.in_flight / self.max_in_flight, "in_flight"),
+            (pool_wait_tracker.recent / self.max_pool_wait, "pool_wait"),
+        )
+        ratio, reason = max(ratios)
+        if ratio >= 2:
+            return STATE_OVERLOADED, reason
+        if ratio >= 1:
+            return STATE_DEGRADED, reason
+        return STATE_OK, ""
+
+    def check_bucket(self, key: str) -> float:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                self.prune_buckets()
+            bucket = self.buckets[key] = TokenBucket(self.list_burst)
+        return bucket.take(self.list_rate, self.list_burst)
+
+    def prune_buckets(self):
+        # a bucket idle long enough to have refilled is the same as a new one
+        full_after = self.list_burst / self.list_rate
+        now = time.monotonic()
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if now - bucket.updated < full_after
+        }
+
+
+admission_controller = AdmissionController()
+admission_state.set_function(lambda: admission_controller.state()[0])
+
+
+def client_key(scope, trust_client_ip: bool = ADMISSION_TRUST_CLIENT_IP) -> Optional[str]:
+    """
+    Rate limit key: the user of a valid bearer token, so a user's tokens share
+    one bucket. Anonymous requests (or an invalid token, which the endpoint
+    rejects anyway) use the client IP if it can be trusted, else None: not
+    rate limited, only shed.
+    """
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                try:
+                    username = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+                except JWTError:
+                    username = None
+                if username:
+                    return "user:" + username
+            break
+    client = scope.get("client")
+    if trust_client_ip and client:
+        return "ip:" + client[0]
+    return None
+
+
+async def reject(send, status_code: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("latin-1")),
+                (b"retry-after", str(max(1, int(retry_after + 0.999))).encode("latin-1")),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionControlMiddleware:
+    """Pure ASGI middleware so that a rejected request costs as little as possible."""
+
+    def __init__(self, app, controller: AdmissionController = None, enabled: bool = ADMISSION_ENABLED):
+        self.app = app
+        self.controller = controller or admission_controller
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        controller = self.controller
+        priority = classify(scope["method"], scope["path"])
+        if priority != "critical":
+            state, reason = controller.state()
+            if (state == STATE_OVERLOADED) or (state == STATE_DEGRADED and priority == "low"):
+                admission_shed_counter.labels(priority=priority, reason=reason).inc()
+                await reject(send, 503, "Server overloaded, retry later", ADMISSION_RETRY_AFTER_SECONDS)
+                return
+
+            key = client_key(scope) if priority == "low" else None
+            if key is not None:
+                wait = controller.check_bucket(key)
+                if wait:
+                    admission_shed_counter.labels(priority=priority, reason="rate_limit").inc()
+                    await reject(send, 429, "Too many list requests, retry later", wait)
+                    return
+
+        controller.in_flight += 1
+        admission_in_flight.set(controller.in_flight)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.in_flight -= 1
+            admission_in_flight.set(controller.in_flight)
@@ -0,0 +1,423 @@
+"""
+Loan analytics served from rollup tables.
+
+Every borrow and return adds to counters in `loan_rollups` in the same
+database transaction as the loan itself (record_borrow / record_return,
+called from crud). Counters are kept per day for five dimensions:
+
+    all      one row per day: loans per day, average loan length, overdue rate
+    genre    per genre
+    author   per author
+    book     per book id: top titles
+    member   per user id: overdue rate per member
+
+A borrow counts on its borrow_date. A return counts on its return_date and
+adds the loan's length in days and whether it came back late. Averages and
+rates are computed from summed counters at query time, so any range is
+answered by adding up rows, not by scanning transactions.
+
+The compaction job folds day rows older than ANALYTICS_DAILY_DAYS into one
+row per month, except for `all`, which stays daily so loans per day can be
+charted over years. A range that starts or ends inside a compacted month is
+widened to the whole month; responses carry the range actually covered.
+
+Every borrow and return would update the same `all` row of the day, and the
+rows of popular genres and authors, holding their row locks until commit,
+which serializes loans across replicas. So those counters are sharded: an
+event adds to shard user_id % ANALYTICS_SHARDS of its row, and queries sum
+over shards. Book and member rows are per title and per member already and
+stay in shard 0, as do rebuilt and compacted rows.
+
+Borrows and returns only ever touch today's rows, so compaction and the
+check do not race with live traffic. `rebuild` recomputes every counter from
+`transactions` and `transactions_archive` with set-based SQL. `check`
+rebuilds into a scratch table and compares it month by month (today
+excluded) with the incremental counters. Genre and author are those of the
+book when the event happened, so books edited since then show up as
+differences until the next rebuild.
+
+    python -m app.analytics compact [--keep-days 90]
+    python -m app.analytics rebuild
+    python -m app.analytics check
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import Column, Date, Integer, MetaData, String, Table, and_, case, cast, func, insert, literal, or_, select, text, union_all
+from sqlalchemy.orm import Session
+
+from . import models
+from .archive import month_start, next_month
+from .db import SessionLocal, dialect_insert, engine
+
+ANALYTICS_DAILY_DAYS = int(os.getenv("ANALYTICS_DAILY_DAYS", "90"))
+ANALYTICS_CHECK_MAX_DIFFERENCES = 20
+# Rows per day and key for the counters every loan (all) or many loans (genre, author) update
+ANALYTICS_SHARDS = int(os.getenv("ANALYTICS_SHARDS", "8"))
+
+# `all` is never compacted: it is one row per day (and shard)
+COMPACTED_DIMENSIONS = ("genre", "author", "book", "member")
+SHARDED_DIMENSIONS = ("all", "genre", "author")
+COUNTERS = ("loans", "returns", "overdue_returns", "loan_days")
+COLUMNS = ("dimension", "period", "period_start", "key") + COUNTERS
+
+rollups = models.LoanRollup.__table__
+
+
+def add_on_conflict(stmt, table: Table):
+    """Make an INSERT add its counters to the row that is already there."""
+    return stmt.on_conflict_do_update(
+        index_elements=["dimension", "period", "period_start", "key", "shard"],
+        set_={name: table.c[name] + stmt.excluded[name] for name in COUNTERS},
+    )
+
+
+# ---------- incremental path ----------
+
+
+def dimension_keys(user_id: int, book_id: int, book: Optional[models.Book]) -> List[Tuple[str, str]]:
+    return [
+        ("all", ""),
+        ("genre", (book.genre if book else None) or ""),
+        ("author", (book.author if book else None) or ""),
+        ("book", str(book_id)),
+        ("member", str(user_id)),
+    ]
+
+
+def record(db: Session, day: date, user_id: int, book_id: int, book: Optional[models.Book], **counters):
+    shard = user_id % ANALYTICS_SHARDS
+    rows = [
+        {
+            "dimension": dimension,
+            "period": "day",
+            "period_start": day,
+            "key": key,
+            "shard": shard if dimension in SHARDED_DIMENSIONS else 0,
+            **{name: counters.get(name, 0) for name in COUNTERS},
+        }
+        for dimension, key in dimension_keys(user_id, book_id, book)
+    ]
+    db.execute(add_on_conflict(dialect_insert(rollups).values(rows), rollups))
+
+
+def record_borrow(db: Session, tx: models.Transaction, book: Optional[models.Book]):
+    """Count a new loan. Not committed: the caller commits it with the loan."""
+    record(db, tx.borrow_date, tx.user_id, tx.book_id, book, loans=1)
+
+
+def record_return(db: Session, tx: models.Transaction, book: Optional[models.Book]):
+    """Count a return. Not committed: the caller commits it with the loan."""
+    record(
+        db, tx.return_date, tx.user_id, tx.book_id, book,
+        returns=1,
+        overdue_returns=int(tx.status == "overdue"),
+        loan_days=(tx.return_date - tx.borrow_date).days,
+    )
+
+
+# ---------- rebuild and compaction ----------
+
+
+def days_between(first, last):
+    if engine.dialect.name == "postgresql":
+        return last - first
+    return cast(func.julianday(last) - func.julianday(first), Integer)
+
+
+def month_of(column):
+    if engine.dialect.name == "postgresql":
+        return cast(func.date_trunc("month", column), Date)
+    return func.date(column, "start of month")
+
+
+def loan_events():
+    """One row per borrow and per return, from live and archived loans."""
+    selects = []
+    for model in (models.Transaction, models.TransactionArchive):
+        t = model.__table__
+        selects.append(select(
+            t.c.borrow_date.label("day"), t.c.user_id, t.c.book_id,
+            literal(1).label("loans"), literal(0).label("returns"),
+            literal(0).label("overdue_returns"), literal(0).label("loan_days"),
+        ))
+        selects.append(select(
+            t.c.return_date, t.c.user_id, t.c.book_id,
+            literal(0), literal(1),
+            case((t.c.status == "overdue", 1), else_=0),
+            days_between(t.c.borrow_date, t.c.return_date),
+        ).where(t.c.return_date.isnot(None)))
+    return union_all(*selects).subquery("events")
+
+
+def compact_month(db: Session, table: Table, month: date) -> int:
+    """Replace one month of day rows with month rows. Returns day rows removed."""
+    day_rows = (
+        table.c.period == "day",
+        table.c.dimension.in_(COMPACTED_DIMENSIONS),
+        table.c.period_start >= month,
+        table.c.period_start < next_month(month),
+    )
+    summed = (
+        select(
+            table.c.dimension, literal("month"), literal(month, Date), table.c.key,
+            *(func.sum(table.c[name]) for name in COUNTERS),
+        )
+        .where(*day_rows)
+        .group_by(table.c.dimension, table.c.key)
+    )
+    db.execute(add_on_conflict(dialect_insert(table).from_select(COLUMNS, summed), table))
+    return db.execute(table.delete().where(*day_rows)).rowcount
+
+
+def compactable_months(db: Session, table: Table, keep_days: int) -> List[date]:
+    boundary = month_start(date.today() - timedelta(days=keep_days))
+    first = db.execute(
+        select(func.min(table.c.period_start)).where(
+            table.c.period == "day",
+            table.c.dimension.in_(COMPACTED_DIMENSIONS),
+            table.c.period_start < boundary,
+        )
+    ).scalar()
+    months = []
+    month = month_start(first) if first else boundary
+    while month < boundary:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def compact(db: Session, keep_days: int = ANALYTICS_DAILY_DAYS) -> int:
+    """Compact every month older than keep_days, one transaction per month."""
+    removed = 0
+    for month in compactable_months(db, rollups, keep_days):
+        count = compact_month(db, rollups, month)
+        db.commit()
+        removed += count
+        print(f"Compacted {month:%Y-%m}: {count} day rows")
+    return removed
+
+
+def build(db: Session, table: Table, keep_days: int = ANALYTICS_DAILY_DAYS):
+    """Recompute table from every loan and compact it, without committing."""
+    events = loan_events()
+    books = models.Book.__table__
+    keys = {
+        "all": None,
+        "genre": func.coalesce(books.c.genre, ""),
+        "author": func.coalesce(books.c.author, ""),
+        "book": cast(events.c.book_id, String),
+        "member": cast(events.c.user_id, String),
+    }
+    db.execute(table.delete())
+    for dimension, key in keys.items():
+        source = events
+        if dimension in ("genre", "author"):
+            source = events.outerjoin(books, books.c.id == events.c.book_id)
+        summed = (
+            select(
+                literal(dimension), literal("day"), events.c.day, key if key is not None else literal(""),
+                *(func.sum(events.c[name]) for name in COUNTERS),
+            )
+            .select_from(source)
+            .group_by(events.c.day, *([key] if key is not None else []))
+        )
+        db.execute(insert(table).from_select(COLUMNS, summed))
+    for month in compactable_months(db, table, keep_days):
+        compact_month(db, table, month)
+
+
+def rebuild(db: Session, keep_days: int = ANALYTICS_DAILY_DAYS):
+    """Replace loan_rollups with counters recomputed from scratch."""
+    if engine.dialect.name == "postgresql":
+        # borrows and returns wait for the new counters instead of adding to the old ones
+        db.execute(text("LOCK TABLE loan_rollups IN EXCLUSIVE MODE"))
+    build(db, rollups, keep_days)
+    db.commit()
+
+
+def monthly_totals(table: Table, before: date):
+    month = month_of(table.c.period_start)
+    return (
+        select(table.c.dimension, table.c.key, month, *(func.sum(table.c[name]) for name in COUNTERS))
+        .where(table.c.period_start < before)
+        .group_by(table.c.dimension, table.c.key, month)
+    )
+
+
+def check(db: Session, keep_days: int = ANALYTICS_DAILY_DAYS) -> Tuple[List, List]:
+    """
+    Compare loan_rollups with a rebuild, per dimension, key and month, up to
+    yesterday. Returns (rows only in the incremental counters, rows only in
+    the rebuild); both empty means they agree.
+    """
+    scratch = Table(
+        "loan_rollups_check", MetaData(),
+        *(
+            Column(
+                column.name, column.type, primary_key=column.primary_key,
+                server_default=column.server_default.arg if column.server_default is not None else None,
+            )
+            for column in rollups.columns
+        ),
+        # throwaway data: skip the WAL on PostgreSQL
+        prefixes=["UNLOGGED"] if engine.dialect.name == "postgresql" else [],
+    )
+    scratch.drop(engine, checkfirst=True)
+    scratch.create(engine)
+    try:
+        build(db, scratch, keep_days)
+        today = date.today()
+        incremental, rebuilt = monthly_totals(rollups, today), monthly_totals(scratch, today)
+        only_incremental = db.execute(incremental.except_(rebuilt).limit(ANALYTICS_CHECK_MAX_DIFFERENCES)).all()
+        only_rebuilt = db.execute(rebuilt.except_(incremental).limit(ANALYTICS_CHECK_MAX_DIFFERENCES)).all()
+        return only_incremental, only_rebuilt
+    finally:
+        db.rollback()
+        scratch.drop(engine)
+
+
+# ---------- queries ----------
+
+
+def covered_range(db: Session, dimension: str, start: date, end: date) -> Tuple[date, date]:
+    """The range a query answers: ends that fall in compacted months widen to the whole month."""
+    if dimension not in COMPACTED_DIMENSIONS:
+        return start, end
+
+    def compacted(month: date) -> bool:
+        return db.execute(
+            select(rollups.c.key).where(
+                rollups.c.dimension == dimension,
+                rollups.c.period == "month",
+                rollups.c.period_start == month,
+            ).limit(1)
+        ).first() is not None
+
+    if compacted(month_start(start)):
+        start = month_start(start)
+    if compacted(month_start(end)):
+        end = next_month(end) - timedelta(days=1)
+    return start, end
+
+
+def with_rates(key: str, loans, returns, overdue_returns, loan_days) -> Dict:
+    returns = int(returns)
+    return {
+        "key": key,
+        "loans": int(loans),
+        "returns": returns,
+        "overdue_returns": int(overdue_returns),
+        "average_loan_days": round(int(loan_days) / returns, 2) if returns else None,
+        "overdue_rate": round(int(overdue_returns) / returns, 4) if returns else None,
+    }
+
+
+def totals(
+    db: Session,
+    dimension: str,
+    start: date,
+    end: date,
+    limit: Optional[int] = None,
+    by_overdue_rate: bool = False,
+    min_returns: int = 0,
+) -> Tuple[date, date, List[Dict]]:
+    """Summed counters per key of a dimension over start..end (inclusive), most loans first."""
+    start, end = covered_range(db, dimension, start, end)
+    sums = {name: func.sum(rollups.c[name]) for name in COUNTERS}
+    query = (
+        select(rollups.c.key, *sums.values())
+        .where(
+            rollups.c.dimension == dimension,
+            or_(
+                and_(rollups.c.period == "day", rollups.c.period_start.between(start, end)),
+                and_(rollups.c.period == "month", rollups.c.period_start.between(month_start(start), end)),
+            ),
+        )
+        .group_by(rollups.c.key)
+    )
+    if by_overdue_rate:
+        query = query.having(sums["returns"] >= max(1, min_returns)).order_by(
+            (sums["overdue_returns"] * 1.0 / sums["returns"]).desc(), sums["returns"].desc(), rollups.c.key
+        )
+    else:
+        if min_returns:
+            query = query.having(sums["returns"] >= min_returns)
+        query = query.order_by(sums["loans"].desc(), rollups.c.key)
+    if limit:
+        query = query.limit(limit)
+    return start, end, [with_rates(*row) for row in db.execute(query)]
+
+
+def add_labels(db: Session, rows: List[Dict], model, column) -> List[Dict]:
+    """Label book and member rows with the current title or username."""
+    ids = [int(row["key"]) for row in rows]
+    labels = dict(db.query(model.id, column).filter(model.id.in_(ids))) if ids else {}
+    for row in rows:
+        row["label"] = labels.get(int(row["key"]))
+    return rows
+
+
+def loans_over_time(db: Session, start: date, end: date, granularity: str = "day") -> List[Dict]:
+    """Counters of the `all` dimension per day, or summed per month."""
+    rows = db.execute(
+        select(rollups.c.period_start, *(rollups.c[name] for name in COUNTERS))
+        .where(
+            rollups.c.dimension == "all",
+            rollups.c.period == "day",
+            rollups.c.period_start.between(start, end),
+        )
+        .order_by(rollups.c.period_start)
+    ).all()
+    buckets: Dict[date, List[int]] = {}
+    for day, *counters in rows:
+        bucket = month_start(day) if granularity == "month" else day
+        current = buckets.setdefault(bucket, [0] * len(COUNTERS))
+        for i, value in enumerate(counters):
+            current[i] += value
+    return [with_rates(bucket.isoformat(), *counters) for bucket, counters in buckets.items()]
+
+
+# ---------- command line ----------
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the loan_rollups analytics tables")
+    parser.add_argument("command", choices=["compact", "rebuild", "check"])
+    parser.add_argument("--keep-days", type=int, default=ANALYTICS_DAILY_DAYS,
+                        help="day rows newer than this are not compacted into months")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        if args.command == "compact":
+            removed = compact(db, args.keep_days)
+            print(f"Compacted {removed} day rows in {time.perf_counter() - started:.1f}s")
+        elif args.command == "rebuild":
+            rebuild(db, args.keep_days)
+            count = db.query(models.LoanRollup).count()
+            print(f"Rebuilt loan_rollups ({count} rows) in {time.perf_counter() - started:.1f}s")
+        else:
+            only_incremental, only_rebuilt = check(db, args.keep_days)
+            elapsed = time.perf_counter() - started
+            if not only_incremental and not only_rebuilt:
+                print(f"loan_rollups matches a rebuild from transactions ({elapsed:.1f}s)")
+                return
+            print(f"loan_rollups differs from a rebuild (showing up to {ANALYTICS_CHECK_MAX_DIFFERENCES} each):")
+            print("  dimension, key, month, loans, returns, overdue_returns, loan_days")
+            for row in only_incremental:
+                print(f"  incremental: {tuple(row)}")
+            for row in only_rebuilt:
+                print(f"  rebuild:     {tuple(row)}")
+            sys.exit(1)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Archival of closed loans.
+
+`transactions` only needs active loans and recent history: return_book looks
+up the borrowed row, /me/transactions and /admin/transactions list recent
+activity. Returned and overdue rows whose return_date is older than
+TRANSACTION_ARCHIVE_DAYS are moved to `transactions_archive` in batches, so
+the hot table (and its indexes) stay the same size however long the library
+has been running. crud reads the archive only when history is requested.
+
+On PostgreSQL `transactions_archive` is range-partitioned by month on
+borrow_date (schema.sql). The API creates the partitioned parent at startup,
+before create_all() would create a plain table, and the partitions a batch
+needs are created before it is moved. A plain table left by an older release
+is converted by the job before it archives (or with --partition). Elsewhere
+the archive is a plain table.
+
+Run by k8s/cronjob-archive.yaml:
+    python -m app.archive [--horizon-days 180] [--batch-size 10000] [--dry-run]
+    python -m app.archive --partition    # only convert a plain archive table
+"""
+import argparse
+import os
+import time
+from datetime import date, timedelta
+
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.orm import Session
+
+from . import models
+from .db import SessionLocal, engine
+
+TRANSACTION_ARCHIVE_DAYS = int(os.getenv("TRANSACTION_ARCHIVE_DAYS", "180"))
+TRANSACTION_ARCHIVE_BATCH_SIZE = int(os.getenv("TRANSACTION_ARCHIVE_BATCH_SIZE", "10000"))
+
+ARCHIVE_COLUMNS = ("id", "user_id", "book_id", "borrow_date", "due_date", "return_date", "status")
+
+# Same definition as schema.sql
+ARCHIVE_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS transactions_archive (
+        id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrow_date DATE NOT NULL,
+        due_date DATE NOT NULL,
+        return_date DATE,
+        status VARCHAR(20) NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (id, borrow_date)
+    ) PARTITION BY RANGE (borrow_date)
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_transactions_archive_user_id ON transactions_archive (user_id, borrow_date)",
+)
+
+
+def archive_cutoff(horizon_days: int = TRANSACTION_ARCHIVE_DAYS) -> date:
+    return date.today() - timedelta(days=horizon_days)
+
+
+def closed_before(cutoff: date):
+    """Filter for rows that can be archived: returned (on time or late) before cutoff."""
+    return (
+        models.Transaction.status.in_(["returned", "overdue"]),
+        models.Transaction.return_date < cutoff,
+    )
+
+
+def archive_relkind(db) -> str:
+    """pg_class.relkind of transactions_archive: 'p' partitioned, 'r' plain, None missing."""
+    return db.execute(
+        text("SELECT relkind FROM pg_class WHERE relname = 'transactions_archive' AND pg_table_is_visible(oid)")
+    ).scalar()
+
+
+def is_partitioned(db: Session) -> bool:
+    if engine.dialect.name != "postgresql":
+        return False
+    return archive_relkind(db) == "p"
+
+
+def create_archive_table(bind=engine):
+    """
+    Create the partitioned archive parent on PostgreSQL. Called before
+    Base.metadata.create_all(), which would otherwise create a plain table.
+    """
+    if bind.dialect.name != "postgresql":
+        return
+    with bind.begin() as conn:
+        relkind = archive_relkind(conn)
+        if relkind is None:
+            for statement in ARCHIVE_DDL:
+                conn.execute(text(statement))
+        elif relkind == "r":
+            print("transactions_archive is not partitioned; the next archive job converts it (python -m app.archive --partition)")
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def create_partitions(db: Session, first: date, last: date):
+    month = month_start(first)
+    while month <= last:
+        following = next_month(month)
+        db.execute(text(
+            f"CREATE TABLE IF NOT EXISTS transactions_archive_{month:%Y_%m} "
+            f"PARTITION OF transactions_archive "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+        ))
+        month = following
+
+
+def ensure_partitions(db: Session, first: date, last: date):
+    """Create the monthly archive partitions covering borrow dates first..last."""
+    create_partitions(db, first, last)
+    db.commit()
+
+
+def partition_archive(db: Session) -> bool:
+    """
+    Convert a plain transactions_archive (created by create_all() in an older
+    release) into the partitioned table, in one database transaction that
+    holds an exclusive lock on the archive. Returns True if it was converted.
+    """
+    if engine.dialect.name != "postgresql" or archive_relkind(db) != "r":
+        return False
+    columns = ", ".join(ARCHIVE_COLUMNS)
+    db.execute(text("LOCK TABLE transactions_archive IN ACCESS EXCLUSIVE MODE"))
+    db.execute(text("ALTER TABLE transactions_archive RENAME TO transactions_archive_plain"))
+    db.execute(text("ALTER INDEX IF EXISTS transactions_archive_pkey RENAME TO transactions_archive_plain_pkey"))
+    for statement in ARCHIVE_DDL:
+        db.execute(text(statement))
+    first, last = db.execute(
+        text("SELECT min(borrow_date), max(borrow_date) FROM transactions_archive_plain")
+    ).one()
+    if first is not None:
+        create_partitions(db, first, last)
+    moved = db.execute(text(
+        f"INSERT INTO transactions_archive ({columns}) SELECT {columns} FROM transactions_archive_plain"
+    )).rowcount
+    db.execute(text("DROP TABLE transactions_archive_plain"))
+    db.commit()
+    print(f"Converted transactions_archive to a partitioned table ({moved} rows)")
+    return True
+
+
+def archive_batch(db: Session, cutoff: date, batch_size: int) -> int:
+    """Move one batch of archivable rows in a single database transaction. Returns rows moved."""
+    hot = models.Transaction.__table__
+    ids_query = (
+        select(hot.c.id)
+        .where(*closed_before(cutoff))
+        .order_by(hot.c.id)
+        .limit(batch_size)
+    )
+    if engine.dialect.name == "postgresql":
+        # replicas running the job at the same time take different rows
+        ids_query = ids_query.with_for_update(skip_locked=True)
+    ids = db.execute(ids_query).scalars().all()
+    if not ids:
+        return 0
+
+    db.execute(
+        insert(models.TransactionArchive.__table__).from_select(
+            ARCHIVE_COLUMNS,
+            select(*(hot.c[name] for name in ARCHIVE_COLUMNS)).where(hot.c.id.in_(ids)),
+        )
+    )
+    db.execute(hot.delete().where(hot.c.id.in_(ids)))
+    db.commit()
+    return len(ids)
+
+
+def archive_closed_transactions(
+    db: Session,
+    horizon_days: int = TRANSACTION_ARCHIVE_DAYS,
+    batch_size: int = TRANSACTION_ARCHIVE_BATCH_SIZE,
+) -> int:
+    """Move every closed loan older than the horizon to the archive. Returns rows moved."""
+    cutoff = archive_cutoff(horizon_days)
+    if is_partitioned(db):
+        first, last = db.query(
+            func.min(models.Transaction.borrow_date), func.max(models.Transaction.borrow_date)
+        ).filter(*closed_before(cutoff)).one()
+        if first is None:
+            return 0
+        ensure_partitions(db, first, last)
+
+    moved = 0
+    while True:
+        count = archive_batch(db, cutoff, batch_size)
+        if not count:
+            return moved
+        moved += count
+        print(f"Archived {moved} transactions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move closed loans older than the horizon to transactions_archive")
+    parser.add_argument("--horizon-days", type=int, default=TRANSACTION_ARCHIVE_DAYS)
+    parser.add_argument("--batch-size", type=int, default=TRANSACTION_ARCHIVE_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="only count the rows that would be moved")
+    parser.add_argument("--partition", action="store_true",
+                        help="only convert a plain transactions_archive to the partitioned table")
+    args = parser.parse_args()
+
+    cutoff = archive_cutoff(args.horizon_days)
+    db = SessionLocal()
+    try:
+        if args.partition:
+            if not partition_archive(db):
+                print("Nothing to convert: transactions_archive is already partitioned (or not on PostgreSQL)")
+            return
+        if args.dry_run:
+            count = db.query(models.Transaction).filter(*closed_before(cutoff)).count()
+            print(f"{count} transactions returned before {cutoff} would be archived")
+            return
+        partition_archive(db)
+        started = time.perf_counter()
+        moved = archive_closed_transactions(db, args.horizon_days, args.batch_size)
+        print(f"Archived {moved} transactions returned before {cutoff} in {time.perf_counter() - started:.1f}s")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
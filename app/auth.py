@@ -2,13 +2,13 @@ from datetime import datetime, timedelta
 from typing import Optional
 import os
 
-import hashlib
 from fastapi import Depends, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 
-from . import models, schemas
+from . import models, passwords, schemas
 from .db import get_db
 
 SECRET_KEY = os.getenv("SECRET_KEY", "replace_this_with_real_secret")  # change later if you like
@@ -17,12 +17,12 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 
 def get_password_hash(password: str) -> str:
-    # simple sha256 hash for this project
-    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+    # hashes in the calling thread; the API uses passwords.hash_async instead
+    return passwords.hash_password(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return get_password_hash(plain_password) == hashed_password
+    return passwords.verify_password(plain_password, hashed_password)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -33,12 +33,31 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[models.User]:
-    user = db.query(models.User).filter(models.User.username == username).first()
+def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
+    return db.query(models.User).filter(models.User.username == username).first()
+
+
+def save_password_hash(db: Session, user: models.User, password_hash: str):
+    user.password_hash = password_hash
+    db.commit()
+
+
+async def authenticate_user(db: Session, username: str, password: str) -> Optional[models.User]:
+    """
+    Verify in the password hash pool, upgrading an outdated stored hash on
+    success. Database work runs in the threadpool, off the event loop.
+    """
+    user = await run_in_threadpool(get_user_by_username, db, username)
     if not user:
+        # same hashing work as a wrong password, see passwords.dummy_hash_async
+        await passwords.verify_and_update_async(password, await passwords.dummy_hash_async())
         return None
-    if not verify_password(password, user.password_hash):
+    valid, new_hash = await passwords.verify_and_update_async(password, user.password_hash)
+    if not valid:
         return None
+    if new_hash:
+        passwords.record_rehash(user.password_hash)
+        await run_in_threadpool(save_password_hash, db, user, new_hash)
     return user
 
 
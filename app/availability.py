@@ -0,0 +1,277 @@
+"""
+In-memory availability index for "what's on the shelf" queries.
+
+Book ids are kept in sorted ``array('i')`` posting lists per genre and per
+shelf, and availability is a bitset indexed by book id. Each book also
+stores a small genre / shelf code so that an update can find the posting
+list it has to leave without touching the database.
+
+Fixed memory cost per book (ignoring the few bytes per distinct genre/shelf):
+    4 bytes  all-books list entry
+    4 bytes  genre posting list entry
+    4 bytes  shelf posting list entry
+    4 bytes  genre code
+    4 bytes  shelf code
+    2 bits   present + available bits
+"""
+from array import array
+from bisect import bisect_left
+import sys
+import threading
+from typing import List, Optional
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+# Code 0 is reserved for books without a genre / shelf
+_NO_KEY = 0
+
+
+def _set_bit(bitmap: bytearray, i: int, value: bool) -> None:
+    if value:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    else:
+        bitmap[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+
+def _get_bit(bitmap: bytearray, i: int) -> bool:
+    return bool(bitmap[i >> 3] & (1 << (i & 7)))
+
+
+def _insert_sorted(ids: array, book_id: int) -> None:
+    pos = bisect_left(ids, book_id)
+    if pos == len(ids) or ids[pos] != book_id:
+        ids.insert(pos, book_id)
+
+
+def _remove_sorted(ids: array, book_id: int) -> None:
+    pos = bisect_left(ids, book_id)
+    if pos < len(ids) and ids[pos] == book_id:
+        del ids[pos]
+
+
+def _contains_sorted(ids: array, book_id: int) -> bool:
+    pos = bisect_left(ids, book_id)
+    return pos < len(ids) and ids[pos] == book_id
+
+
+class _KeyIndex:
+    """Posting lists for one attribute (genre or shelf_location)."""
+
+    def __init__(self):
+        self.codes: dict = {}
+        self.names: List[Optional[str]] = [None]
+        self.postings: List[array] = [array("i")]
+        self.book_codes = array("I")
+
+    def code_for(self, key: Optional[str]) -> int:
+        if key is None:
+            return _NO_KEY
+        code = self.codes.get(key)
+        if code is None:
+            code = len(self.names)
+            self.codes[key] = code
+            self.names.append(key)
+            self.postings.append(array("i"))
+        return code
+
+    def ensure_capacity(self, book_id: int) -> None:
+        missing = book_id + 1 - len(self.book_codes)
+        if missing > 0:
+            self.book_codes.extend([_NO_KEY] * missing)
+
+    def add(self, book_id: int, key: Optional[str]) -> None:
+        code = self.code_for(key)
+        self.book_codes[book_id] = code
+        _insert_sorted(self.postings[code], book_id)
+
+    def remove(self, book_id: int) -> None:
+        code = self.book_codes[book_id]
+        _remove_sorted(self.postings[code], book_id)
+        self.book_codes[book_id] = _NO_KEY
+
+    def lookup(self, key: str) -> Optional[array]:
+        code = self.codes.get(key)
+        if code is None:
+            return None
+        return self.postings[code]
+
+    def nbytes(self) -> int:
+        total = sys.getsizeof(self.book_codes)
+        for ids in self.postings:
+            total += sys.getsizeof(ids)
+        return total
+
+
+class AvailabilityIndex:
+    """
+    Book availability keyed by genre and shelf, answered without DB access.
+
+    Built once from models.Book at startup (and periodically rebuilt, since
+    other replicas write to the same database), then updated in place by
+    crud on borrow, return and book create/update/delete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Updates made while build() is reading the books table, replayed
+        # onto the new structures so the swap does not lose them
+        self._pending: Optional[list] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self._genre = _KeyIndex()
+        self._shelf = _KeyIndex()
+        self._all = array("i")
+        self._present = bytearray()
+        self._available = bytearray()
+
+    def _ensure_capacity(self, book_id: int) -> None:
+        missing = (book_id >> 3) + 1 - len(self._present)
+        if missing > 0:
+            self._present.extend(bytes(missing))
+            self._available.extend(bytes(missing))
+        self._genre.ensure_capacity(book_id)
+        self._shelf.ensure_capacity(book_id)
+
+    def _remove(self, book_id: int) -> None:
+        if book_id >= len(self._present) * 8 or not _get_bit(self._present, book_id):
+            return
+        self._genre.remove(book_id)
+        self._shelf.remove(book_id)
+        _remove_sorted(self._all, book_id)
+        _set_bit(self._present, book_id, False)
+        _set_bit(self._available, book_id, False)
+
+    def _upsert(self, book_id, genre, shelf_location, available) -> None:
+        self._remove(book_id)
+        self._ensure_capacity(book_id)
+        self._genre.add(book_id, genre)
+        self._shelf.add(book_id, shelf_location)
+        _insert_sorted(self._all, book_id)
+        _set_bit(self._present, book_id, True)
+        _set_bit(self._available, book_id, bool(available))
+
+    def build(self, db: Session) -> None:
+        """
+        Rebuild the whole index from the books table.
+
+        A borrow or return on this pod can commit after the SELECT has read
+        the row but before the swap. Updates made while the build runs are
+        recorded and replayed onto the new index after the swap, so they are
+        not lost; replaying one the snapshot already includes is harmless.
+        """
+        with self._lock:
+            self._pending = []
+        try:
+            rows = (
+                db.query(
+                    models.Book.id,
+                    models.Book.genre,
+                    models.Book.shelf_location,
+                    models.Book.available,
+                )
+                .order_by(models.Book.id)
+                .all()
+            )
+
+            fresh = AvailabilityIndex.__new__(AvailabilityIndex)
+            fresh._reset()
+            if rows:
+                fresh._ensure_capacity(rows[-1][0])
+            for book_id, genre, shelf, available in rows:
+                # rows come sorted by id, so plain appends keep postings sorted
+                for keys, key in ((fresh._genre, genre), (fresh._shelf, shelf)):
+                    code = keys.code_for(key)
+                    keys.book_codes[book_id] = code
+                    keys.postings[code].append(book_id)
+                fresh._all.append(book_id)
+                _set_bit(fresh._present, book_id, True)
+                _set_bit(fresh._available, book_id, bool(available))
+
+            with self._lock:
+                self._genre = fresh._genre
+                self._shelf = fresh._shelf
+                self._all = fresh._all
+                self._present = fresh._present
+                self._available = fresh._available
+                for update, args in self._pending:
+                    update(*args)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _record(self, update, *args) -> None:
+        update(*args)
+        if self._pending is not None:
+            self._pending.append((update, args))
+
+    def _set_available(self, book_id: int, available: bool) -> None:
+        if book_id < len(self._present) * 8 and _get_bit(self._present, book_id):
+            _set_bit(self._available, book_id, available)
+
+    def upsert(self, book: models.Book) -> None:
+        with self._lock:
+            self._record(self._upsert, book.id, book.genre, book.shelf_location, book.available)
+
+    def set_available(self, book_id: int, available: bool) -> None:
+        with self._lock:
+            self._record(self._set_available, book_id, available)
+
+    def remove(self, book_id: int) -> None:
+        with self._lock:
+            self._record(self._remove, book_id)
+
+    def available_ids(
+        self,
+        genre: Optional[str] = None,
+        shelf: Optional[str] = None,
+    ) -> List[int]:
+        """Return ids of available books matching the given genre and/or shelf."""
+        with self._lock:
+            candidates = self._all
+            other = None
+            if genre is not None:
+                candidates = self._genre.lookup(genre)
+                if candidates is None:
+                    return []
+            if shelf is not None:
+                shelf_ids = self._shelf.lookup(shelf)
+                if shelf_ids is None:
+                    return []
+                if genre is None:
+                    candidates = shelf_ids
+                elif len(shelf_ids) < len(candidates):
+                    candidates, other = shelf_ids, candidates
+                else:
+                    other = shelf_ids
+
+            available = self._available
+            result = []
+            for book_id in candidates:
+                if not available[book_id >> 3] & (1 << (book_id & 7)):
+                    continue
+                if other is not None and not _contains_sorted(other, book_id):
+                    continue
+                result.append(book_id)
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            books = len(self._all)
+            nbytes = (
+                sys.getsizeof(self._all)
+                + sys.getsizeof(self._present)
+                + sys.getsizeof(self._available)
+                + self._genre.nbytes()
+                + self._shelf.nbytes()
+            )
+        return {
+            "books": books,
+            "memory_bytes": nbytes,
+            "bytes_per_book": round(nbytes / books, 2) if books else 0.0,
+        }
+
+
+availability_index = AvailabilityIndex()
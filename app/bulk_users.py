@@ -0,0 +1,246 @@
+"""
+Bulk user import for POST /users/bulk.
+
+The request body is read as it arrives, one user per line: NDJSON objects
+({"username": ..., "password": ..., "role": ...}) or, with a text/csv
+content type, CSV with a username,password,role header line. Rows are
+handled BULK_USER_BATCH_SIZE at a time:
+
+  1. validate each row; a username repeated within the batch is a conflict
+  2. hash the batch's passwords in the password process pool
+     (passwords.hash_many_async), in chunks so waiting logins get a worker
+  3. insert the batch with one INSERT ... ON CONFLICT (username) DO NOTHING
+     RETURNING (crud.insert_users); usernames not returned already existed
+
+Every batch commits on its own, so a failed upload can simply be sent again:
+rows that made it in come back as conflicts. Per-row results go to a spooled
+temporary file as each batch finishes and are streamed back once the whole
+body has been read, so memory depends on the batch size and not on the
+upload size. (Answering while the client is still uploading would deadlock
+clients that only read the response after sending the body.)
+
+Results are written in upload order: invalid rows wait with the batch they
+fall in, and a batch is flushed once it holds BULK_USER_BATCH_SIZE rows of
+either kind.
+
+Throughput is bounded by hashing. At the login cost (bcrypt 10, about 80 ms
+per hash per core) each PASSWORD_HASH_WORKERS process creates about 12
+accounts per second, so add workers (and CPU) for large imports. An opt-in
+BULK_PASSWORD_HASH_COST hashes faster at a lower cost until first login, see
+app/passwords.py; list the accounts still on it with:
+    python -m app.bulk_users pending-rehash
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client import Counter
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+
+from . import crud, models, schemas
+from .db import SessionLocal
+from .passwords import bulk_hasher, hash_many_async, hasher, needs_rehash
+
+BULK_USER_BATCH_SIZE = int(os.getenv("BULK_USER_BATCH_SIZE", "500"))
+BULK_USER_MAX_LINE_BYTES = int(os.getenv("BULK_USER_MAX_LINE_BYTES", "4096"))
+# Results above this size spill from memory to a temporary file
+BULK_USER_RESULT_SPOOL_BYTES = 1024 * 1024
+
+ROLES = ("admin", "member")
+USERNAME_MAX_LENGTH = 50
+CSV_COLUMNS = ["username", "password", "role"]
+
+bulk_users_counter = Counter(
+    'lms_bulk_users_total',
+    'Rows processed by POST /users/bulk',
+    ['status']
+)
+
+
+class BulkImportError(Exception):
+    """The upload as a whole cannot be read; rows before it have been imported."""
+
+
+async def read_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    """Split a byte stream into (line number, line) pairs without holding more than one line."""
+    buffer = b""
+    number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            yield number, line
+        if len(buffer) > BULK_USER_MAX_LINE_BYTES:
+            raise BulkImportError(f"Line {number + 1} is longer than {BULK_USER_MAX_LINE_BYTES} bytes")
+    if buffer:
+        yield number + 1, buffer
+
+
+def parse_ndjson(line: str) -> dict:
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError("expected a JSON object")
+    return row
+
+
+def parse_csv(line: str, header: List[str]) -> dict:
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"expected {len(header)} columns, got {len(values)}")
+    return dict(zip(header, values))
+
+
+def validate(row: dict) -> schemas.UserCreate:
+    user_in = schemas.UserCreate(**row)
+    if not 0 < len(user_in.username) <= USERNAME_MAX_LENGTH:
+        raise ValueError(f"username must be 1 to {USERNAME_MAX_LENGTH} characters")
+    if not user_in.password:
+        raise ValueError("password must not be empty")
+    if user_in.role not in ROLES:
+        raise ValueError(f"role must be one of {', '.join(ROLES)}")
+    return user_in
+
+
+def error_message(exc: Exception) -> str:
+    if isinstance(exc, ValidationError):
+        return "; ".join(f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in exc.errors())
+    return str(exc)
+
+
+async def parse_rows(
+    chunks: AsyncIterator[bytes], content_type: str
+) -> AsyncIterator[Tuple[int, Optional[schemas.UserCreate], Optional[str]]]:
+    """Yield (line, user, None) for valid rows and (line, None, error) for invalid ones."""
+    is_csv = content_type.split(";")[0].strip().lower() == "text/csv"
+    header: Optional[List[str]] = None
+    async for number, raw in read_lines(chunks):
+        try:
+            line = raw.decode("utf-8").strip()
+        except UnicodeDecodeError:
+            yield number, None, "not valid UTF-8"
+            continue
+        if not line:
+            continue
+        if is_csv and header is None:
+            header = [column.strip().lower() for column in next(csv.reader([line]))]
+            if sorted(header) != sorted(CSV_COLUMNS):
+                raise BulkImportError(f"CSV header must be {','.join(CSV_COLUMNS)}")
+            continue
+        try:
+            row = parse_csv(line, header) if is_csv else parse_ndjson(line)
+            yield number, validate(row), None
+        except (ValueError, TypeError, ValidationError) as exc:
+            yield number, None, error_message(exc)
+
+
+async def import_batch(db: Session, batch: List[Tuple[int, schemas.UserCreate]]) -> List[Dict]:
+    results: List[Dict] = []
+    unique: List[Tuple[int, schemas.UserCreate]] = []
+    seen = set()
+    for number, user_in in batch:
+        if user_in.username in seen:
+            results.append({"line": number, "username": user_in.username, "status": "conflict",
+                            "error": "username repeated in this upload"})
+        else:
+            seen.add(user_in.username)
+            unique.append((number, user_in))
+
+    hashes = await hash_many_async([user_in.password for _, user_in in unique])
+    rows = [
+        {"username": user_in.username, "password_hash": password_hash, "role": user_in.role}
+        for (_, user_in), password_hash in zip(unique, hashes)
+    ]
+    inserted = await run_in_threadpool(crud.insert_users, db, rows)
+
+    for number, user_in in unique:
+        if user_in.username in inserted:
+            results.append({"line": number, "username": user_in.username, "status": "created",
+                            "id": inserted[user_in.username]})
+        else:
+            results.append({"line": number, "username": user_in.username, "status": "conflict",
+                            "error": "username already exists"})
+    return results
+
+
+async def import_users(db: Session, chunks: AsyncIterator[bytes], content_type: str, out) -> Dict:
+    """Import every row of the upload, writing one NDJSON result per row to out. Returns the summary."""
+    start = time.perf_counter()
+    counts = {"created": 0, "conflict": 0, "invalid": 0}
+
+    def write(results: List[Dict]):
+        for result in results:
+            counts[result["status"]] += 1
+            bulk_users_counter.labels(status=result["status"]).inc()
+            out.write(json.dumps(result).encode("utf-8") + b"\n")
+
+    async def flush():
+        results = invalid + (await import_batch(db, batch) if batch else [])
+        write(sorted(results, key=lambda result: result["line"]))
+        batch.clear()
+        invalid.clear()
+
+    # invalid rows are held back with the batch so results stay in upload order
+    batch: List[Tuple[int, schemas.UserCreate]] = []
+    invalid: List[Dict] = []
+    async for number, user_in, error in parse_rows(chunks, content_type):
+        if error is not None:
+            invalid.append({"line": number, "status": "invalid", "error": error})
+        else:
+            batch.append((number, user_in))
+        if len(batch) + len(invalid) >= BULK_USER_BATCH_SIZE:
+            await flush()
+    await flush()
+
+    summary = {**counts, "password_cost": bulk_hasher.cost, "seconds": round(time.perf_counter() - start, 3)}
+    out.write(json.dumps({"summary": summary}).encode("utf-8") + b"\n")
+    return summary
+
+
+def result_file():
+    return tempfile.SpooledTemporaryFile(max_size=BULK_USER_RESULT_SPOOL_BYTES)
+
+
+def iter_results(out, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Stream the result file from the start, closing (and deleting) it at the end."""
+    try:
+        out.seek(0)
+        while True:
+            chunk = out.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        out.close()
+
+
+def pending_rehash(db: Session) -> List[str]:
+    """Usernames whose stored hash is outdated (a lower bulk cost, another hasher or legacy SHA-256)."""
+    users = db.query(models.User.username, models.User.password_hash).order_by(models.User.username)
+    return [username for username, password_hash in users if needs_rehash(password_hash)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk user import maintenance")
+    parser.add_argument("command", choices=["pending-rehash"])
+    parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        usernames = pending_rehash(db)
+        for username in usernames:
+            print(username)
+        print(f"{len(usernames)} accounts have a password hash other than {hasher.name} cost {hasher.cost}; "
+              "it is upgraded at their next login")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 from sqlalchemy.orm import Session
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from sqlalchemy import desc
+from typing import Dict, List
+import os
 
-from . import models, schemas
+from . import analytics, models, schemas
+from .db import dialect_insert
 from .auth import get_password_hash
+from .availability import availability_index
 
+# How long a returned copy is held for the member told it is ready
+RESERVATION_HOLD_HOURS = float(os.getenv("RESERVATION_HOLD_HOURS", "48"))
 
-def create_user(db: Session, user_in: schemas.UserCreate) -> models.User:
-    hashed = get_password_hash(user_in.password)
+
+def create_user(db: Session, user_in: schemas.UserCreate, password_hash: str | None = None) -> models.User:
+    # the API hashes in the password pool and passes the result in
+    hashed = password_hash or get_password_hash(user_in.password)
     db_user = models.User(
         username=user_in.username,
         password_hash=hashed,
@@ -19,11 +27,33 @@ def create_user(db: Session, user_in: schemas.UserCreate) -> models.User:
     return db_user
 
 
+def insert_users(db: Session, rows: List[dict]) -> Dict[str, int]:
+    """
+    Insert many users in one statement. rows are dicts of username,
+    password_hash and role. Returns {username: id} for the rows inserted;
+    usernames that already exist are skipped, not raised.
+    """
+    if not rows:
+        return {}
+    users = models.User.__table__
+    created_at = datetime.utcnow()
+    stmt = (
+        dialect_insert(users)
+        .values([{**row, "created_at": created_at} for row in rows])
+        .on_conflict_do_nothing(index_elements=["username"])
+        .returning(users.c.id, users.c.username)
+    )
+    inserted = {username: user_id for user_id, username in db.execute(stmt)}
+    db.commit()
+    return inserted
+
+
 def create_book(db: Session, book_in: schemas.BookCreate) -> models.Book:
     db_book = models.Book(**book_in.dict())
     db.add(db_book)
     db.commit()
     db.refresh(db_book)
+    availability_index.upsert(db_book)
     return db_book
 
 
@@ -44,6 +74,7 @@ def update_book(db: Session, book_id: int, book_in: schemas.BookUpdate):
         setattr(book, field, value)
     db.commit()
     db.refresh(book)
+    availability_index.upsert(book)
     return book
 
 
@@ -53,6 +84,7 @@ def delete_book(db: Session, book_id: int) -> bool:
         return False
     db.delete(book)
     db.commit()
+    availability_index.remove(book_id)
     return True
 
 
@@ -60,6 +92,10 @@ def borrow_book(db: Session, user_id: int, book_id: int, days: int = 14):
     book = db.query(models.Book).get(book_id)
     if not book or not book.available:
         return None
+    # a copy handed to a waiting member can only be borrowed by that member
+    hold = active_hold(db, book_id)
+    if hold and hold.user_id != user_id:
+        return None
     today = date.today()
     due = today + timedelta(days=days)
     tx = models.Transaction(
@@ -71,12 +107,31 @@ def borrow_book(db: Session, user_id: int, book_id: int, days: int = 14):
     )
     book.available = False
     db.add(tx)
+    # borrowing a reserved title takes the member off its waitlist
+    db.query(models.Reservation).filter(
+        models.Reservation.user_id == user_id,
+        models.Reservation.book_id == book_id,
+    ).delete(synchronize_session=False)
+    # any other notified reservation left is an expired hold: that turn has passed
+    db.query(models.Reservation).filter(
+        models.Reservation.book_id == book_id,
+        models.Reservation.notified_at.isnot(None),
+    ).delete(synchronize_session=False)
+    # counters last: today's shared rollup rows stay locked only until the commit
+    db.flush()
+    analytics.record_borrow(db, tx, book)
     db.commit()
     db.refresh(tx)
+    availability_index.set_available(book_id, False)
     return tx
 
 
 def return_book(db: Session, user_id: int, book_id: int):
+    """
+    Close the member's active loan of book_id and, in the same database
+    transaction, hold the copy for the next member on its waitlist.
+    Returns (transaction, reservation or None), or None if there was no loan.
+    """
     # find the most recent active borrowing for this user and book
     tx = (
         db.query(models.Transaction)
@@ -101,66 +156,211 @@ def return_book(db: Session, user_id: int, book_id: int):
 
     # mark the book as available again
     book = db.query(models.Book).get(book_id)
+    reservation = None
     if book:
         book.available = True
+        # a returner who also queued for the book does not get it back
+        db.query(models.Reservation).filter(
+            models.Reservation.user_id == user_id,
+            models.Reservation.book_id == book_id,
+        ).delete(synchronize_session=False)
+        reservation = hand_off_reservation(db, book_id)
 
+    db.flush()
+    analytics.record_return(db, tx, book)
     db.commit()
     db.refresh(tx)
-    return tx
+    if book:
+        availability_index.set_available(book_id, True)
+    return tx, reservation
 
 
-def list_transactions_for_user(db: Session, user_id: int):
+def create_reservation(db: Session, user_id: int, book_id: int) -> models.Reservation:
+    reservation = models.Reservation(user_id=user_id, book_id=book_id)
+    db.add(reservation)
+    db.commit()
+    db.refresh(reservation)
+    return reservation
+
+
+def get_reservation(db: Session, reservation_id: int):
+    return db.query(models.Reservation).get(reservation_id)
+
+
+def get_user_reservation(db: Session, user_id: int, book_id: int):
     return (
-        db.query(models.Transaction)
-        .filter(models.Transaction.user_id == user_id)
-        .order_by(desc(models.Transaction.borrow_date))
+        db.query(models.Reservation)
+        .filter(
+            models.Reservation.user_id == user_id,
+            models.Reservation.book_id == book_id,
+        )
+        .first()
+    )
+
+
+def delete_reservation(db: Session, reservation: models.Reservation) -> None:
+    db.delete(reservation)
+    db.commit()
+
+
+def list_reservations_for_user(db: Session, user_id: int):
+    return (
+        db.query(models.Reservation)
+        .filter(models.Reservation.user_id == user_id)
+        .order_by(models.Reservation.id)
         .all()
     )
 
+
+def hold_expiry() -> datetime:
+    """Holds notified before this time have expired."""
+    return datetime.utcnow() - timedelta(hours=RESERVATION_HOLD_HOURS)
+
+
+def active_hold(db: Session, book_id: int):
+    """The reservation the available copy of book_id is held for, or None."""
+    return (
+        db.query(models.Reservation)
+        .filter(
+            models.Reservation.book_id == book_id,
+            models.Reservation.notified_at >= hold_expiry(),
+        )
+        .order_by(models.Reservation.notified_at.desc())
+        .first()
+    )
+
+
+def has_active_loan(db: Session, user_id: int, book_id: int) -> bool:
+    return db.query(models.Transaction.id).filter(
+        models.Transaction.user_id == user_id,
+        models.Transaction.book_id == book_id,
+        models.Transaction.status == "borrowed",
+    ).first() is not None
+
+
+def hand_off_reservation(db: Session, book_id: int):
+    """
+    Hold the copy for the next member waiting for book_id: mark their
+    reservation notified and return it, or None if nobody is waiting. Not
+    committed: the caller commits it together with the return (or expiry).
+
+    The waitlist is FIFO by reservation id. Until the hold expires
+    (RESERVATION_HOLD_HOURS after notified_at) borrow_book refuses everyone
+    else; the notified member's reservation is deleted when they borrow.
+    """
+    reservation = (
+        db.query(models.Reservation)
+        .filter(
+            models.Reservation.book_id == book_id,
+            models.Reservation.notified_at.is_(None),
+        )
+        .order_by(models.Reservation.id)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if reservation:
+        reservation.notified_at = datetime.utcnow()
+    return reservation
+
+
+def expire_holds(db: Session) -> List[models.Reservation]:
+    """
+    Delete reservations whose hold expired without a borrow and pass each copy
+    on to the next member waiting for it. Returns the newly notified
+    reservations, committed.
+    """
+    expired = (
+        db.query(models.Reservation)
+        .filter(models.Reservation.notified_at < hold_expiry())
+        .order_by(models.Reservation.id)
+        # replicas running this at the same time take different rows
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    notified = []
+    for reservation in expired:
+        book_id = reservation.book_id
+        db.delete(reservation)
+        db.flush()
+        book = db.query(models.Book).get(book_id)
+        if book and book.available and active_hold(db, book_id) is None:
+            next_reservation = hand_off_reservation(db, book_id)
+            if next_reservation:
+                notified.append(next_reservation)
+    db.commit()
+    return notified
+
+
+def list_transactions_for_user(db: Session, user_id: int, include_history: bool = False):
+    """Active and recent loans; with include_history also the archived ones (app/archive.py)."""
+    models_to_read = [models.Transaction]
+    if include_history:
+        models_to_read.append(models.TransactionArchive)
+
+    rows = []
+    for model in models_to_read:
+        rows.extend(
+            db.query(model)
+            .filter(model.user_id == user_id)
+            .order_by(desc(model.borrow_date))
+            .all()
+        )
+    if include_history:
+        rows.sort(key=lambda tx: tx.borrow_date, reverse=True)
+    return rows
+
 def list_transactions_admin(
     db: Session,
     status: str | None = None,
     user_id: int | None = None,
     unreturned_only: bool = False,
+    include_history: bool = False,
 ):
-    # join transactions with users and books
-    query = (
-        db.query(
-            models.Transaction,
-            models.User.username,
-            models.Book.title,
+    models_to_read = [models.Transaction]
+    # the archive only holds returned and overdue loans, never borrowed ones
+    if include_history and (unreturned_only or status != "borrowed"):
+        models_to_read.append(models.TransactionArchive)
+
+    results: list[dict] = []
+    for model in models_to_read:
+        # join transactions with users and books
+        query = (
+            db.query(
+                model,
+                models.User.username,
+                models.Book.title,
+            )
+            .join(models.User, model.user_id == models.User.id)
+            .join(models.Book, model.book_id == models.Book.id)
         )
-        .join(models.User, models.Transaction.user_id == models.User.id)
-        .join(models.Book, models.Transaction.book_id == models.Book.id)
-    )
 
-    if user_id is not None:
-        query = query.filter(models.Transaction.user_id == user_id)
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
 
-    if unreturned_only:
-        query = query.filter(models.Transaction.status.in_(["borrowed", "overdue"]))
-    elif status is not None:
-        query = query.filter(models.Transaction.status == status)
+        if unreturned_only:
+            query = query.filter(model.status.in_(["borrowed", "overdue"]))
+        elif status is not None:
+            query = query.filter(model.status == status)
 
-    query = query.order_by(desc(models.Transaction.borrow_date))
+        query = query.order_by(desc(model.borrow_date))
 
-    rows = query.all()
+        rows = query.all()
 
-    results: list[dict] = []
-    for tx, username, book_title in rows:
-        results.append(
-            {
-                "id": tx.id,
-                "user_id": tx.user_id,
-                "username": username,
-                "book_id": tx.book_id,
-                "book_title": book_title,
-                "borrow_date": tx.borrow_date,
-                "due_date": tx.due_date,
-                "return_date": tx.return_date,
-                "status": tx.status,
-            }
-        )
+        for tx, username, book_title in rows:
+            results.append(
+                {
+                    "id": tx.id,
+                    "user_id": tx.user_id,
+                    "username": username,
+                    "book_id": tx.book_id,
+                    "book_title": book_title,
+                    "borrow_date": tx.borrow_date,
+                    "due_date": tx.due_date,
+                    "return_date": tx.return_date,
+                    "status": tx.status,
+                }
+            )
 
+    if len(models_to_read) > 1:
+        results.sort(key=lambda row: row["borrow_date"], reverse=True)
     return results
-
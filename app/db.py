@@ -1,6 +1,10 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 import os
+import time
+
+from .runtime import db_pool_capacity, db_pool_checked_out, mark_thread_start, pool_wait_tracker
 
 DB_USER = os.getenv("DB_USER", "lms_user")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "lms_password")
@@ -8,15 +12,56 @@ DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME", "lms_db")
 
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# DATABASE_URL overrides the DB_* settings, e.g. sqlite:///bench.db for benchmark.py
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# SQLite connections are used from worker threads, not only the thread that opened them
+CONNECT_ARGS = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait_tracker.observe(time.perf_counter() - start)
+
+
+engine = create_engine(
+    DATABASE_URL,
+    future=True,
+    connect_args=CONNECT_ARGS,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+)
+db_pool_checked_out.set_function(lambda: engine.pool.checkedout())
+db_pool_capacity.set(DB_POOL_SIZE + DB_MAX_OVERFLOW)
 
-engine = create_engine(DATABASE_URL, future=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, future=True)
 
 Base = declarative_base()
 
 
+def dialect_insert(table):
+    """INSERT supporting on_conflict_do_nothing/do_update on PostgreSQL and SQLite."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
 def get_db():
+    # sync dependency, so this runs in a worker thread
+    mark_thread_start()
     db = SessionLocal()
     try:
         yield db
@@ -1,5 +1,13 @@
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import json
+import os
+import random
+import signal
 import time
+import uuid
+from collections import deque
+from datetime import date, timedelta
 
 from fastapi import (
     FastAPI,
@@ -11,17 +19,40 @@ from fastapi import (
     Query,
     Request,
 )
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 from prometheus_fastapi_instrumentator import Instrumentator
 from prometheus_client import Counter, Histogram, Gauge
 
-from .db import Base, engine, get_db
-from . import models, schemas, crud, auth
+from .db import Base, DB_MAX_OVERFLOW, DB_POOL_SIZE, SessionLocal, engine, get_db
+from . import models, schemas, crud, auth, analytics, archive, bulk_users
+from .admission import ADMISSION_RETRY_AFTER_SECONDS, AdmissionControlMiddleware
+from .availability import availability_index
+from .passwords import LoginOverloaded, dummy_hash_async, hash_async, hash_pool, login_limiter
+from .profiling import (
+    PROFILE_MAX_SECONDS,
+    ProfilingMiddleware,
+    sampling_profiler,
+    summary as profile_summary,
+    to_collapsed,
+    to_speedscope,
+)
+from .runtime import (
+    THREADPOOL_SIZE,
+    ThreadpoolQueueMiddleware,
+    check_pool_sizes,
+    configure_threadpool,
+    gc_pause_timer,
+    loop_lag_monitor,
+)
 
 
-# Create tables on startup if they do not exist
+# Create tables on startup if they do not exist; the partitioned archive
+# (PostgreSQL) first, so create_all does not create it as a plain table
+archive.create_archive_table(engine)
 Base.metadata.create_all(bind=engine)
 
 app = FastAPI(title="Library Management System")
@@ -54,6 +85,98 @@ active_websocket_connections = Gauge(
     'Number of active WebSocket connections'
 )
 
+availability_index_books = Gauge(
+    'lms_availability_index_books',
+    'Number of books held in the in-memory availability index'
+)
+availability_index_books.set_function(lambda: availability_index.stats()["books"])
+
+availability_index_memory = Gauge(
+    'lms_availability_index_memory_bytes',
+    'Approximate memory used by the in-memory availability index'
+)
+availability_index_memory.set_function(lambda: availability_index.stats()["memory_bytes"])
+
+reservation_notifications_counter = Counter(
+    'lms_reservation_notifications_total',
+    'Reservation hand-offs, by whether the member was connected to receive the push',
+    ['delivered']
+)
+
+active_member_websocket_connections = Gauge(
+    'lms_member_websocket_connections_active',
+    'Number of active member WebSocket connections'
+)
+
+book_ws_connections = Gauge(
+    'lms_book_ws_connections_active',
+    'Number of active /ws/books subscriber connections'
+)
+
+book_ws_subscriptions = Gauge(
+    'lms_book_ws_subscriptions_active',
+    'Number of (connection, topic) subscriptions on /ws/books'
+)
+
+book_ws_topics = Gauge(
+    'lms_book_ws_topics_active',
+    'Number of topics (book, genre or shelf) with at least one /ws/books subscriber'
+)
+
+book_ws_messages_sent = Counter(
+    'lms_book_ws_messages_sent_total',
+    'book_update messages delivered to /ws/books subscribers'
+)
+
+book_ws_dropped = Counter(
+    'lms_book_ws_dropped_total',
+    '/ws/books connections closed for not keeping up (queue_full) or a send that timed out or failed',
+    ['reason']
+)
+
+ws_frames_sent = Counter(
+    'lms_ws_frames_sent_total',
+    'WebSocket frames queued for admin dashboards'
+)
+
+ws_dropped = Counter(
+    'lms_ws_dropped_total',
+    'Admin dashboard connections closed for not keeping up (queue_full) or a send that timed out or failed',
+    ['reason']
+)
+
+ws_frames_saved = Counter(
+    'lms_ws_frames_saved_total',
+    'Admin WebSocket frames avoided by coalescing events into one frame'
+)
+
+ws_events_coalesced = Counter(
+    'lms_ws_events_coalesced_total',
+    'book_update events replaced by a newer event for the same book within the coalescing window'
+)
+
+ws_coalesce_wait = Histogram(
+    'lms_ws_coalesce_wait_seconds',
+    'Time an event waits in the coalescing window before it is sent',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+)
+
+ws_replays = Counter(
+    'lms_ws_replays_total',
+    'Admin WebSocket reconnects with ?since=, by whether events were replayed or a resync was required',
+    ['result']
+)
+
+ws_replayed_events = Counter(
+    'lms_ws_replayed_events_total',
+    'Events replayed to reconnecting admin dashboards'
+)
+
+ws_drained_connections = Counter(
+    'lms_ws_drained_connections_total',
+    'WebSocket connections closed with a reconnect hint during shutdown'
+)
+
 # Counter for suspicious/attack requests (separate from normal metrics)
 suspicious_request_counter = Counter(
     'lms_api_suspicious_requests_total',
@@ -105,7 +228,10 @@ LEGITIMATE_ENDPOINTS = [
     '/me/transactions',
     '/admin/transactions',
     '/users',
+    '/reservations',
     '/ws/admin',
+    '/ws/member',
+    '/ws/books',
 ]
 
 
@@ -137,6 +263,12 @@ def is_suspicious_request(path: str) -> bool:
     return False
 
 
+# Admission control sits inside metrics_middleware so shed requests show up as 503/429
+app.add_middleware(AdmissionControlMiddleware)
+# Only does work while GET /admin/profile is running
+app.add_middleware(ProfilingMiddleware)
+
+
 # Middleware to track API metrics
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
@@ -179,6 +311,102 @@ async def metrics_middleware(request: Request, call_next):
     return response
 
 
+# Registered last, so it is the outermost layer and threadpool queue time is
+# measured from request arrival, before metrics_middleware runs
+app.add_middleware(ThreadpoolQueueMiddleware)
+
+
+# ------------- Startup -------------
+
+# Other replicas borrow and return against the same database, so the local
+# availability index is rebuilt periodically to pick up their changes: that
+# bounds how stale /books/available can be for books changed elsewhere. Each
+# rebuild reads the whole books table, so with one replica (or a large
+# catalog) set it to 0 (never) or raise it; k8s/deployment.yaml sets it.
+AVAILABILITY_INDEX_REFRESH_SECONDS = float(os.getenv("AVAILABILITY_INDEX_REFRESH_SECONDS", "60"))
+# How often expired reservation holds (crud.RESERVATION_HOLD_HOURS) are passed on
+RESERVATION_HOLD_CHECK_SECONDS = float(os.getenv("RESERVATION_HOLD_CHECK_SECONDS", "60"))
+
+
+def rebuild_availability_index():
+    db = SessionLocal()
+    try:
+        availability_index.build(db)
+    finally:
+        db.close()
+
+
+async def refresh_availability_index():
+    while True:
+        await asyncio.sleep(AVAILABILITY_INDEX_REFRESH_SECONDS)
+        try:
+            await run_in_threadpool(rebuild_availability_index)
+        except Exception as exc:
+            print(f"Availability index refresh failed: {exc}")
+
+
+def reservation_ready_event(reservation: models.Reservation) -> dict:
+    return {
+        "event": "reservation_ready",
+        "reservation_id": reservation.id,
+        "book_id": reservation.book_id,
+        "title": reservation.book.title,
+        "notified_at": reservation.notified_at.isoformat(),
+        "hold_until": (reservation.notified_at + timedelta(hours=crud.RESERVATION_HOLD_HOURS)).isoformat(),
+    }
+
+
+async def notify_reservation_ready(username: str, event: dict):
+    delivered = await member_manager.send_to_user(username, event)
+    reservation_notifications_counter.labels(delivered=str(delivered).lower()).inc()
+
+
+def expire_reservation_holds() -> List[Tuple[str, dict]]:
+    db = SessionLocal()
+    try:
+        return [
+            (reservation.user.username, reservation_ready_event(reservation))
+            for reservation in crud.expire_holds(db)
+        ]
+    finally:
+        db.close()
+
+
+async def pass_on_expired_holds():
+    """Give copies nobody collected in time to the next member in line."""
+    while True:
+        await asyncio.sleep(RESERVATION_HOLD_CHECK_SECONDS)
+        try:
+            for username, event in await run_in_threadpool(expire_reservation_holds):
+                await notify_reservation_ready(username, event)
+        except Exception as exc:
+            print(f"Reservation hold expiry failed: {exc}")
+
+
+@app.on_event("startup")
+async def startup():
+    configure_threadpool(THREADPOOL_SIZE)
+    check_pool_sizes(THREADPOOL_SIZE, DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    gc_pause_timer.install()
+    await run_in_threadpool(rebuild_availability_index)
+    print(f"Availability index built: {availability_index.stats()}")
+    if AVAILABILITY_INDEX_REFRESH_SECONDS > 0:
+        print(f"Availability index: full rebuild from books every {AVAILABILITY_INDEX_REFRESH_SECONDS:g}s")
+        asyncio.create_task(refresh_availability_index())
+    else:
+        print("Availability index: periodic rebuild disabled, changes from other replicas are not picked up")
+    asyncio.create_task(pass_on_expired_holds())
+    asyncio.create_task(loop_lag_monitor.run())
+    install_drain_handler()
+    await hash_pool.warm_up()
+    await dummy_hash_async()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    hash_pool.shutdown()
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
@@ -188,11 +416,19 @@ def health_check():
 
 
 @app.post("/auth/login", response_model=schemas.Token)
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db),
 ):
-    user = auth.authenticate_user(db, form_data.username, form_data.password)
+    try:
+        async with login_limiter:
+            user = await auth.authenticate_user(db, form_data.username, form_data.password)
+    except LoginOverloaded:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many logins in progress, retry later",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER_SECONDS)},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -203,13 +439,33 @@ def login(
 
 
 @app.post("/users/", response_model=schemas.UserOut)
-def create_user(
+async def create_user(
     user_in: schemas.UserCreate,
     db: Session = Depends(get_db),
     _: models.User = Depends(auth.get_current_admin),
 ):
     """Admin only create a new user"""
-    return crud.create_user(db, user_in)
+    password_hash = await hash_async(user_in.password)
+    return await run_in_threadpool(crud.create_user, db, user_in, password_hash)
+
+
+@app.post("/users/bulk")
+async def bulk_create_users(
+    request: Request,
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    """
+    Admin only create many users from an NDJSON (or text/csv) upload, one user
+    per line. Responds with one NDJSON result per row and a summary line.
+    """
+    out = bulk_users.result_file()
+    try:
+        await bulk_users.import_users(db, request.stream(), request.headers.get("content-type", ""), out)
+    except bulk_users.BulkImportError as exc:
+        out.close()
+        raise HTTPException(status_code=400, detail=str(exc))
+    return StreamingResponse(bulk_users.iter_results(out), media_type="application/x-ndjson")
 
 
 # ------------- Books CRUD -------------
@@ -220,6 +476,16 @@ def get_books(db: Session = Depends(get_db)):
     return crud.list_books(db)
 
 
+@app.get("/books/available", response_model=schemas.AvailableBooksOut)
+async def get_available_books(
+    genre: Optional[str] = Query(None, description="Only books in this genre"),
+    shelf: Optional[str] = Query(None, description="Only books on this shelf_location"),
+):
+    """Available book ids by genre and/or shelf, served from the in-memory index"""
+    book_ids = availability_index.available_ids(genre=genre, shelf=shelf)
+    return {"genre": genre, "shelf": shelf, "count": len(book_ids), "book_ids": book_ids}
+
+
 @app.get("/books/{book_id}", response_model=schemas.BookOut)
 def get_book(book_id: int, db: Session = Depends(get_db)):
     """Get a single book by its ID, including availability status"""
@@ -274,21 +540,15 @@ async def borrow_book(
 ):
     tx = crud.borrow_book(db, user_id=user.id, book_id=req.book_id, days=req.days)
     if not tx:
+        hold = crud.active_hold(db, req.book_id)
+        if hold and hold.user_id != user.id:
+            raise HTTPException(status_code=409, detail="Book is held for a member on the waitlist")
         raise HTTPException(status_code=400, detail="Book not available")
 
     # fetch updated book for availability broadcast
     book = db.query(models.Book).get(tx.book_id)
     if book:
-        await manager.broadcast(
-            {
-                "event": "book_update",
-                "book_id": book.id,
-                "title": book.title,
-                "available": book.available,
-                "genre": book.genre,
-                "shelf_location": book.shelf_location,
-            }
-        )
+        await publish_book_update(book)
 
     return {
         "transaction_id": tx.id,
@@ -304,25 +564,21 @@ async def return_book(
     db: Session = Depends(get_db),
     user: models.User = Depends(auth.get_current_member),
 ):
-    tx = crud.return_book(db, user_id=user.id, book_id=req.book_id)
-    if not tx:
+    returned = crud.return_book(db, user_id=user.id, book_id=req.book_id)
+    if not returned:
         raise HTTPException(
             status_code=400,
             detail="No active borrowing found for this user and book",
         )
+    tx, reservation = returned
 
     book = db.query(models.Book).get(tx.book_id)
     if book:
-        await manager.broadcast(
-            {
-                "event": "book_update",
-                "book_id": book.id,
-                "title": book.title,
-                "available": book.available,
-                "genre": book.genre,
-                "shelf_location": book.shelf_location,
-            }
-        )
+        await publish_book_update(book)
+
+    # the freed copy is now held for the next member on the waitlist
+    if reservation:
+        await notify_reservation_ready(reservation.user.username, reservation_ready_event(reservation))
 
     return {
         "transaction_id": tx.id,
@@ -332,6 +588,53 @@ async def return_book(
     }
 
 
+# ------------- Reservations -------------
+
+
+@app.post("/reservations", response_model=schemas.ReservationOut)
+def create_reservation(
+    req: schemas.ReservationCreate,
+    db: Session = Depends(get_db),
+    user: models.User = Depends(auth.get_current_member),
+):
+    """
+    Join the FIFO waitlist for a book that is borrowed or held for another member.
+    When a copy is returned it is held for RESERVATION_HOLD_HOURS for the next
+    member in line, who is pushed a reservation_ready event on /ws/member.
+    """
+    book = crud.get_book(db, req.book_id)
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+    if crud.has_active_loan(db, user.id, req.book_id):
+        raise HTTPException(status_code=409, detail="You already have this book on loan")
+    if book.available and crud.active_hold(db, req.book_id) is None:
+        raise HTTPException(status_code=400, detail="Book is available, borrow it instead")
+    if crud.get_user_reservation(db, user.id, req.book_id):
+        raise HTTPException(status_code=400, detail="Book already reserved")
+    return crud.create_reservation(db, user_id=user.id, book_id=req.book_id)
+
+
+@app.get("/reservations", response_model=List[schemas.ReservationOut])
+def list_my_reservations(
+    db: Session = Depends(get_db),
+    user: models.User = Depends(auth.get_current_member),
+):
+    return crud.list_reservations_for_user(db, user.id)
+
+
+@app.delete("/reservations/{reservation_id}")
+def delete_reservation(
+    reservation_id: int,
+    db: Session = Depends(get_db),
+    user: models.User = Depends(auth.get_current_member),
+):
+    reservation = crud.get_reservation(db, reservation_id)
+    if not reservation or (reservation.user_id != user.id and user.role != "admin"):
+        raise HTTPException(status_code=404, detail="Reservation not found")
+    crud.delete_reservation(db, reservation)
+    return {"deleted": True}
+
+
 # ------------- Transactions -------------
 
 
@@ -339,12 +642,16 @@ async def return_book(
 def list_my_transactions(
     db: Session = Depends(get_db),
     user: models.User = Depends(auth.get_current_member),
+    include_history: bool = Query(
+        False,
+        description="If true, also return archived loans returned more than TRANSACTION_ARCHIVE_DAYS ago",
+    ),
 ):
     """
-    Return all borrowing transactions for the currently logged in user,
+    Return the borrowing transactions for the currently logged in user,
     ordered by most recent borrow first.
     """
-    return crud.list_transactions_for_user(db, user.id)
+    return crud.list_transactions_for_user(db, user.id, include_history=include_history)
 
 
 @app.get("/admin/transactions", response_model=List[schemas.AdminTransactionOut])
@@ -363,6 +670,10 @@ def admin_list_transactions(
         False,
         description="If true, only show books that have not been returned yet",
     ),
+    include_history: bool = Query(
+        False,
+        description="If true, also search archived loans returned more than TRANSACTION_ARCHIVE_DAYS ago",
+    ),
 ):
     if status is not None and status not in {"borrowed", "returned", "overdue"}:
         raise HTTPException(status_code=400, detail="Invalid status value")
@@ -372,40 +683,636 @@ def admin_list_transactions(
         status=status,
         user_id=user_id,
         unreturned_only=unreturned_only,
+        include_history=include_history,
+    )
+
+
+# ------------- Analytics -------------
+
+# Served from loan_rollups (app/analytics.py), not from the transactions tables
+ANALYTICS_DEFAULT_DAYS = 30
+
+
+def analytics_range(start: Optional[date], end: Optional[date]) -> Tuple[date, date]:
+    end = end or date.today()
+    start = start or end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+
+def analytics_report(db: Session, report: str, dimension: str, start, end, **options) -> dict:
+    start, end = analytics_range(start, end)
+    start, end, rows = analytics.totals(db, dimension, start, end, **options)
+    if dimension == "book":
+        analytics.add_labels(db, rows, models.Book, models.Book.title)
+    elif dimension == "member":
+        analytics.add_labels(db, rows, models.User, models.User.username)
+    else:
+        for row in rows:
+            row["label"] = row["key"] or None
+    return {"report": report, "start": start, "end": end, "rows": rows}
+
+
+@app.get("/admin/analytics/loans", response_model=schemas.AnalyticsOut)
+def analytics_loans(
+    start: Optional[date] = Query(None, description="First day (default: 30 days before end)"),
+    end: Optional[date] = Query(None, description="Last day, inclusive (default: today)"),
+    granularity: str = Query("day", description="day or month"),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    """Loans, returns, average loan length and overdue rate per day or month"""
+    if granularity not in {"day", "month"}:
+        raise HTTPException(status_code=400, detail="Invalid granularity value")
+    start, end = analytics_range(start, end)
+    rows = analytics.loans_over_time(db, start, end, granularity)
+    return {"report": f"loans_per_{granularity}", "start": start, "end": end, "rows": rows}
+
+
+@app.get("/admin/analytics/summary", response_model=schemas.AnalyticsOut)
+def analytics_summary(
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    """Totals over the range, including average loan length and overdue rate"""
+    return analytics_report(db, "summary", "all", start, end)
+
+
+@app.get("/admin/analytics/genres", response_model=schemas.AnalyticsOut)
+def analytics_genres(
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    return analytics_report(db, "loans_per_genre", "genre", start, end)
+
+
+@app.get("/admin/analytics/authors", response_model=schemas.AnalyticsOut)
+def analytics_authors(
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    limit: int = Query(20, gt=0, le=1000),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    return analytics_report(db, "loans_per_author", "author", start, end, limit=limit)
+
+
+@app.get("/admin/analytics/top-titles", response_model=schemas.AnalyticsOut)
+def analytics_top_titles(
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    limit: int = Query(10, gt=0, le=1000),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    """Most borrowed books; key is the book id, label its title"""
+    return analytics_report(db, "top_titles", "book", start, end, limit=limit)
+
+
+@app.get("/admin/analytics/overdue-rate", response_model=schemas.AnalyticsOut)
+def analytics_overdue_rate(
+    start: Optional[date] = Query(None),
+    end: Optional[date] = Query(None),
+    limit: int = Query(20, gt=0, le=1000),
+    min_returns: int = Query(1, ge=1, description="Ignore members with fewer returns in the range"),
+    db: Session = Depends(get_db),
+    _: models.User = Depends(auth.get_current_admin),
+):
+    """Members by share of returns that came back late; key is the user id, label the username"""
+    return analytics_report(
+        db, "overdue_rate_per_member", "member", start, end,
+        limit=limit, by_overdue_rate=True, min_returns=min_returns,
     )
 
 
+# ------------- Profiling -------------
+
+
+@app.get("/admin/profile")
+async def admin_profile(
+    _: models.User = Depends(auth.get_current_admin),
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS, description="How long to sample live requests"),
+    route: Optional[str] = Query(None, description="Only profile this route path, e.g. /books/{book_id}"),
+    sample: float = Query(1.0, gt=0, le=1, description="Fraction of requests to profile (stacks and SQL of the same requests)"),
+    format: str = Query("collapsed", description="collapsed or speedscope"),
+):
+    """
+    Sample the stacks of live requests for `seconds` and return a flame graph.
+
+    collapsed output can be fed to flamegraph.pl or speedscope; the SQL time of
+    the profiled requests is in the X-Profile-* headers (and in the profile
+    name for speedscope).
+    """
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or speedscope")
+
+    endpoint_codes = None
+    if route is not None:
+        endpoint_codes = {
+            app_route.endpoint.__code__
+            for app_route in app.routes
+            if getattr(app_route, "endpoint", None) is not None and app_route.path == route
+        }
+        if not endpoint_codes:
+            raise HTTPException(status_code=404, detail="Route not found")
+
+    try:
+        sampling_profiler.start(engine, endpoint_codes, route=route, sample=sample)
+    except RuntimeError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        session = sampling_profiler.stop()
+
+    info = profile_summary(session)
+    headers = {
+        "X-Profile-Requests": str(info["requests"]),
+        "X-Profile-Samples": str(info["samples"]),
+        "X-Profile-Request-Seconds": str(info["request_seconds"]),
+        "X-Profile-SQL-Seconds": str(info["sql_seconds"]),
+        "X-Profile-SQL-Statements": str(info["sql_statements"]),
+    }
+    if format == "speedscope":
+        return JSONResponse(to_speedscope(session), headers=headers)
+    return PlainTextResponse(to_collapsed(session), headers=headers)
+
+
 # ------------- WebSocket for admin availability updates -------------
 
 
+# Events arriving within this window are deduplicated by book_id and sent as one frame
+WS_COALESCE_WINDOW_MS = float(os.getenv("WS_COALESCE_WINDOW_MS", "50"))
+# Number of sent events kept for clients reconnecting with ?since=<seq>
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "1000"))
+# Frames waiting for one admin socket; a dashboard that falls this far behind is dropped
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+# A single send to an admin socket taking longer than this drops the socket
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "5"))
+# WebSocket close code 1013: try again later
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class SocketQueues:
+    """
+    A bounded send queue and a sender task per WebSocket.
+
+    send() never waits for the client: it puts the text on the socket's queue
+    and the socket's own task sends it. A socket whose queue is full, or whose
+    send takes longer than send_timeout, is dropped: on_drop(websocket) removes
+    it from its manager, the drop is counted in `dropped` by reason and the
+    socket is closed with 1013 so the client reconnects.
+    """
+
+    def __init__(
+        self,
+        on_drop: Callable[[WebSocket], None],
+        dropped: Counter,
+        queue_size: int,
+        send_timeout: float,
+    ):
+        self.on_drop = on_drop
+        self.dropped = dropped
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.senders: Dict[WebSocket, asyncio.Task] = {}
+
+    def add(self, websocket: WebSocket):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.queues[websocket] = queue
+        self.senders[websocket] = asyncio.create_task(self.send_loop(websocket, queue))
+
+    def remove(self, websocket: WebSocket):
+        self.queues.pop(websocket, None)
+        sender = self.senders.pop(websocket, None)
+        if sender is not None and sender is not asyncio.current_task():
+            sender.cancel()
+
+    def send(self, websocket: WebSocket, text: str) -> bool:
+        """Queue one message for one socket. Returns False if the socket is gone or was dropped."""
+        queue = self.queues.get(websocket)
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self.drop(websocket, "queue_full")
+            return False
+        return True
+
+    def drop(self, websocket: WebSocket, reason: str):
+        """Disconnect a socket that cannot keep up and close it in the background."""
+        if websocket not in self.queues:
+            return
+        self.remove(websocket)
+        self.on_drop(websocket)
+        self.dropped.labels(reason=reason).inc()
+        asyncio.create_task(self.close(websocket))
+
+    async def close(self, websocket: WebSocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER), self.send_timeout)
+        except Exception:
+            pass
+
+    async def send_loop(self, websocket: WebSocket, queue: asyncio.Queue):
+        while True:
+            text = await queue.get()
+            try:
+                await asyncio.wait_for(websocket.send_text(text), self.send_timeout)
+            except asyncio.TimeoutError:
+                self.drop(websocket, "timeout")
+                return
+            except Exception:
+                self.drop(websocket, "send_failed")
+                return
+            finally:
+                queue.task_done()
+
+    async def drain(self):
+        """Wait (at most send_timeout) for every queued message to be sent, then stop the senders."""
+        pending = [queue.join() for queue in self.queues.values()]
+        if pending:
+            try:
+                await asyncio.wait_for(asyncio.gather(*pending), self.send_timeout)
+            except asyncio.TimeoutError:
+                pass
+        for websocket in list(self.queues):
+            self.remove(websocket)
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """
+    Admin dashboard sockets.
+
+    broadcast() does not send right away: events are held for
+    WS_COALESCE_WINDOW_MS, deduplicated by book_id (last writer wins) and sent
+    as a single frame that is serialized once for every socket. A window with
+    one event is sent as a plain book_update, more than one as
+    {"event": "book_updates", "updates": [...]}. A window of 0 sends every
+    event immediately.
+
+    Every sent event carries a "seq" that increases by one per event and a
+    "stream" id that changes whenever the process restarts. The last
+    WS_REPLAY_BUFFER_SIZE events are kept so that a dashboard reconnecting with
+    ?since=<seq>&stream=<id> only receives what it missed.
+
+    Frames are never sent inline: each socket has a queue of at most
+    WS_QUEUE_SIZE frames and its own sender task (see SocketQueues), so a
+    stalled dashboard is dropped after WS_SEND_TIMEOUT_SECONDS instead of
+    holding up /borrow, /return and every other dashboard. Sequencing and
+    queueing never await, so a reconnecting socket gets its replay and then
+    every later event exactly once, in order.
+    """
 
-    async def connect(self, websocket: WebSocket):
+    def __init__(
+        self,
+        coalesce_window_ms: float = WS_COALESCE_WINDOW_MS,
+        replay_buffer_size: int = WS_REPLAY_BUFFER_SIZE,
+        queue_size: int = WS_QUEUE_SIZE,
+        send_timeout: float = WS_SEND_TIMEOUT_SECONDS,
+    ):
+        self.active_connections: List[WebSocket] = []
+        self.outgoing = SocketQueues(self.disconnect, ws_dropped, queue_size, send_timeout)
+        self.stream_id = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.replay_buffer: deque = deque(maxlen=replay_buffer_size)
+        self.coalesce_window = coalesce_window_ms / 1000
+        # book_id -> (latest event, time it was queued)
+        self.pending: Dict[object, Tuple[dict, float]] = {}
+        self.pending_events = 0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        since: Optional[int] = None,
+        stream: Optional[str] = None,
+    ):
         await websocket.accept()
+        self.outgoing.add(websocket)
+        self.outgoing.send(websocket, json.dumps({"event": "hello", "stream": self.stream_id, "seq": self.seq}))
+        if since is not None:
+            self.replay(websocket, since, stream)
         self.active_connections.append(websocket)
         active_websocket_connections.set(len(self.active_connections))
         print(f"Admin WS connected. Total: {len(self.active_connections)}")
 
+    def replay(self, websocket: WebSocket, since: int, stream: Optional[str]):
+        """Queue the events after `since`, or resync_required if they are no longer buffered."""
+        oldest = self.replay_buffer[0]["seq"] if self.replay_buffer else self.seq + 1
+        if (stream is not None and stream != self.stream_id) or since > self.seq or since < oldest - 1:
+            ws_replays.labels(result="resync").inc()
+            self.outgoing.send(
+                websocket, json.dumps({"event": "resync_required", "stream": self.stream_id, "seq": self.seq})
+            )
+            return
+
+        missed = [message for message in self.replay_buffer if message["seq"] > since]
+        ws_replays.labels(result="replayed").inc()
+        ws_replayed_events.inc(len(missed))
+        if len(missed) == 1:
+            self.outgoing.send(websocket, json.dumps(missed[0]))
+        elif missed:
+            self.outgoing.send(websocket, json.dumps({"event": "book_updates", "updates": missed}))
+
     def disconnect(self, websocket: WebSocket):
+        self.outgoing.remove(websocket)
         if websocket in self.active_connections:
             self.active_connections.remove(websocket)
             active_websocket_connections.set(len(self.active_connections))
             print(f"Admin WS disconnected. Total: {len(self.active_connections)}")
 
+    def sequence(self, message: dict) -> dict:
+        self.seq += 1
+        message = dict(message, seq=self.seq, stream=self.stream_id)
+        self.replay_buffer.append(message)
+        return message
+
     async def broadcast(self, message: dict):
-        disconnected: List[WebSocket] = []
-        for connection in self.active_connections:
+        if self.coalesce_window <= 0:
+            self.send_frame(json.dumps(self.sequence(message)), events=1)
+            return
+
+        key = message.get("book_id", id(message))
+        if key in self.pending:
+            ws_events_coalesced.inc()
+        self.pending[key] = (message, time.perf_counter())
+        self.pending_events += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_after_window())
+
+    async def flush_after_window(self):
+        await asyncio.sleep(self.coalesce_window)
+        await self.flush()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        events, self.pending_events = self.pending_events, 0
+        self.flush_task = None
+        if not pending:
+            return
+
+        now = time.perf_counter()
+        messages = []
+        for message, queued_at in pending.values():
+            ws_coalesce_wait.observe(now - queued_at)
+            messages.append(self.sequence(message))
+
+        if len(messages) == 1:
+            frame = messages[0]
+        else:
+            frame = {"event": "book_updates", "updates": messages}
+        self.send_frame(json.dumps(frame), events=events)
+
+    def send_frame(self, text: str, events: int):
+        """Queue one pre-serialized frame for every admin socket."""
+        sent = sum(self.outgoing.send(connection, text) for connection in list(self.active_connections))
+        ws_frames_sent.inc(sent)
+        ws_frames_saved.inc((events - 1) * sent)
+
+
+manager = ConnectionManager()
+
+
+class MemberConnectionManager:
+    """Member sockets keyed by username, for pushes aimed at one member."""
+
+    def __init__(self):
+        self.connections: Dict[str, List[WebSocket]] = {}
+
+    async def connect(self, username: str, websocket: WebSocket):
+        await websocket.accept()
+        self.connections.setdefault(username, []).append(websocket)
+        active_member_websocket_connections.inc()
+
+    def disconnect(self, username: str, websocket: WebSocket):
+        sockets = self.connections.get(username, [])
+        if websocket in sockets:
+            sockets.remove(websocket)
+            active_member_websocket_connections.dec()
+            if not sockets:
+                del self.connections[username]
+
+    async def send_to_user(self, username: str, message: dict) -> bool:
+        """Send to every socket of one member. Returns True if at least one got it."""
+        delivered = False
+        for connection in list(self.connections.get(username, [])):
             try:
                 await connection.send_json(message)
+                delivered = True
             except Exception:
-                disconnected.append(connection)
-        for ws in disconnected:
-            self.disconnect(ws)
+                self.disconnect(username, connection)
+        return delivered
 
 
-manager = ConnectionManager()
+member_manager = MemberConnectionManager()
+
+
+# A topic is ("book", book_id), ("genre", genre) or ("shelf", shelf_location)
+Topic = Tuple[str, object]
+
+MAX_TOPICS_PER_CONNECTION = int(os.getenv("MAX_TOPICS_PER_CONNECTION", "1000"))
+# Messages waiting for one /ws/books socket; a socket that falls this far behind is dropped
+BOOK_WS_QUEUE_SIZE = int(os.getenv("BOOK_WS_QUEUE_SIZE", "100"))
+# A single send taking longer than this drops the socket
+BOOK_WS_SEND_TIMEOUT_SECONDS = float(os.getenv("BOOK_WS_SEND_TIMEOUT_SECONDS", "5"))
+
+
+class BookSubscriptionManager:
+    """
+    Topic-to-connection index for /ws/books.
+
+    An event is only sent to sockets subscribed to one of its topics, so the
+    work per event is O(subscribers of those topics), not O(connections).
+    Idle connections cost one entry in `subscriptions` plus one set entry per
+    topic they follow.
+
+    publish() never waits for a client: it puts the serialized event on each
+    recipient's queue (at most BOOK_WS_QUEUE_SIZE messages) and every socket
+    has its own sender task (see SocketQueues). A socket whose queue is full, or whose send takes
+    longer than BOOK_WS_SEND_TIMEOUT_SECONDS, is closed with 1013 so the
+    client reconnects and resubscribes, instead of holding up /borrow and
+    /return or the other subscribers.
+    """
+
+    def __init__(self, queue_size: int = BOOK_WS_QUEUE_SIZE, send_timeout: float = BOOK_WS_SEND_TIMEOUT_SECONDS):
+        self.topics: Dict[Topic, Set[WebSocket]] = {}
+        self.subscriptions: Dict[WebSocket, Set[Topic]] = {}
+        self.outgoing = SocketQueues(self.disconnect, book_ws_dropped, queue_size, send_timeout)
+        self.subscription_count = 0
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        self.subscriptions[websocket] = set()
+        self.outgoing.add(websocket)
+        book_ws_connections.inc()
+
+    def disconnect(self, websocket: WebSocket):
+        topics = self.subscriptions.pop(websocket, None)
+        if topics is None:
+            return
+        self.outgoing.remove(websocket)
+        for topic in topics:
+            self._remove(topic, websocket)
+        self.subscription_count -= len(topics)
+        book_ws_connections.dec()
+        self._update_gauges()
+
+    def send(self, websocket: WebSocket, message: dict) -> bool:
+        """Queue one message for one socket. Returns False if the socket was dropped."""
+        return self.outgoing.send(websocket, json.dumps(message))
+
+    def _remove(self, topic: Topic, websocket: WebSocket):
+        sockets = self.topics.get(topic)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.topics[topic]
+
+    def _update_gauges(self):
+        book_ws_subscriptions.set(self.subscription_count)
+        book_ws_topics.set(len(self.topics))
+
+    def subscribe(self, websocket: WebSocket, topics: List[Topic]) -> int:
+        current = self.subscriptions[websocket]
+        try:
+            for topic in topics:
+                if topic in current:
+                    continue
+                if len(current) >= MAX_TOPICS_PER_CONNECTION:
+                    raise ValueError(f"At most {MAX_TOPICS_PER_CONNECTION} topics per connection")
+                current.add(topic)
+                self.topics.setdefault(topic, set()).add(websocket)
+                self.subscription_count += 1
+        finally:
+            self._update_gauges()
+        return len(current)
+
+    def unsubscribe(self, websocket: WebSocket, topics: List[Topic]) -> int:
+        current = self.subscriptions[websocket]
+        for topic in topics:
+            if topic in current:
+                current.discard(topic)
+                self._remove(topic, websocket)
+                self.subscription_count -= 1
+        self._update_gauges()
+        return len(current)
+
+    def publish(self, message: dict):
+        topics = [
+            ("book", message["book_id"]),
+            ("genre", message.get("genre")),
+            ("shelf", message.get("shelf_location")),
+        ]
+        recipients: Set[WebSocket] = set()
+        for topic in topics:
+            sockets = self.topics.get(topic)
+            if sockets:
+                recipients.update(sockets)
+        if not recipients:
+            return
+
+        # serialize once for every recipient
+        text = json.dumps(message)
+        queued = sum(self.outgoing.send(connection, text) for connection in recipients)
+        book_ws_messages_sent.inc(queued)
+
+
+book_subscriptions = BookSubscriptionManager()
+
+
+# Clients are told to wait a random 0..WS_RECONNECT_JITTER_MS before reconnecting,
+# so dashboards on a drained pod do not all come back at the same moment
+WS_RECONNECT_JITTER_MS = int(os.getenv("WS_RECONNECT_JITTER_MS", "5000"))
+# WebSocket close code 1012: service restart
+WS_CLOSE_SERVICE_RESTART = 1012
+
+
+async def close_with_reconnect_hint(websocket: WebSocket, hint: dict):
+    try:
+        await websocket.send_json(
+            {"event": "reconnect", **hint, "after_ms": random.randint(0, WS_RECONNECT_JITTER_MS)}
+        )
+        await websocket.close(code=WS_CLOSE_SERVICE_RESTART)
+        ws_drained_connections.inc()
+    except Exception:
+        pass
+
+
+async def drain_websockets():
+    """Close every WebSocket with a jittered reconnect hint before the server shuts down."""
+    await manager.flush()
+    await asyncio.gather(manager.outgoing.drain(), book_subscriptions.outgoing.drain())
+    hint = {"stream": manager.stream_id, "seq": manager.seq}
+    sockets = list(manager.active_connections)
+    for sockets_of_user in member_manager.connections.values():
+        sockets.extend(sockets_of_user)
+    sockets.extend(book_subscriptions.subscriptions)
+    print(f"Draining {len(sockets)} WebSocket connections")
+    await asyncio.gather(*(close_with_reconnect_hint(ws, hint) for ws in sockets))
+
+
+def install_drain_handler():
+    """
+    Run drain_websockets() on SIGTERM, then hand the signal to the previous
+    handler (uvicorn's), which stops the server as usual.
+    """
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm():
+        loop.remove_signal_handler(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, previous)
+
+        def pass_on(_):
+            if callable(previous):
+                previous(signal.SIGTERM, None)
+            else:
+                signal.raise_signal(signal.SIGTERM)
+
+        loop.create_task(drain_websockets()).add_done_callback(pass_on)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, on_sigterm)
+    except (NotImplementedError, RuntimeError, ValueError):
+        # not on the main thread (e.g. TestClient) or not supported on this platform
+        pass
+
+
+def book_update_event(book: models.Book) -> dict:
+    return {
+        "event": "book_update",
+        "book_id": book.id,
+        "title": book.title,
+        "available": book.available,
+        "genre": book.genre,
+        "shelf_location": book.shelf_location,
+    }
+
+
+async def publish_book_update(book: models.Book):
+    """Send a book_update to admin dashboards and to /ws/books subscribers of the book."""
+    message = book_update_event(book)
+    await manager.broadcast(message)
+    book_subscriptions.publish(message)
+
+
+def parse_topics(message: dict) -> List[Topic]:
+    topics: List[Topic] = []
+    for book_id in message.get("book_ids") or []:
+        topics.append(("book", int(book_id)))
+    for genre in message.get("genres") or []:
+        topics.append(("genre", str(genre)))
+    for shelf in message.get("shelves") or []:
+        topics.append(("shelf", str(shelf)))
+    return topics
 
 
 @app.websocket("/ws/admin")
@@ -417,12 +1324,25 @@ async def admin_websocket(websocket: WebSocket):
     ws://127.0.0.1:8000/ws/admin?token=JWT_TOKEN_HERE
 
     Only JWTs with role=admin are allowed.
+
+    To resume after a disconnect, pass the last seen seq and stream:
+    ws://127.0.0.1:8000/ws/admin?token=JWT_TOKEN_HERE&since=42&stream=STREAM_ID
+
+    Missed events are replayed; if they are no longer buffered (or the stream
+    changed) a resync_required event tells the client to reload in full.
     """
     token = websocket.query_params.get("token")
     if not token:
         await websocket.close(code=4401)
         return
 
+    since = websocket.query_params.get("since")
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        await websocket.close(code=4400)
+        return
+
     try:
         payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
         role = payload.get("role")
@@ -433,10 +1353,100 @@ async def admin_websocket(websocket: WebSocket):
         await websocket.close(code=4401)
         return
 
-    await manager.connect(websocket)
+    await manager.connect(websocket, since=since, stream=websocket.query_params.get("stream"))
     try:
         while True:
             # Optional: receive ping or other admin messages (currently ignored)
             await websocket.receive_text()
     except WebSocketDisconnect:
         manager.disconnect(websocket)
+
+
+@app.websocket("/ws/member")
+async def member_websocket(websocket: WebSocket):
+    """
+    WebSocket endpoint for member notifications (reservation_ready).
+
+    Connect with:
+    ws://127.0.0.1:8000/ws/member?token=JWT_TOKEN_HERE
+
+    Notifications are also recorded in notified_at, so a member who was not
+    connected (or is connected to another replica) sees them via GET /reservations.
+    """
+    token = websocket.query_params.get("token")
+    if not token:
+        await websocket.close(code=4401)
+        return
+
+    try:
+        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+        username = payload.get("sub")
+        if username is None or payload.get("role") not in ("member", "admin"):
+            await websocket.close(code=4403)
+            return
+    except JWTError:
+        await websocket.close(code=4401)
+        return
+
+    await member_manager.connect(username, websocket)
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        member_manager.disconnect(username, websocket)
+
+
+@app.websocket("/ws/books")
+async def books_websocket(websocket: WebSocket):
+    """
+    WebSocket endpoint for members and kiosks following specific titles.
+
+    Connect with:
+    ws://127.0.0.1:8000/ws/books?token=JWT_TOKEN_HERE
+
+    Then send JSON messages to choose what to follow:
+    {"action": "subscribe", "book_ids": [1, 2], "genres": ["Fiction"], "shelves": ["Shelf-3"]}
+    {"action": "unsubscribe", "book_ids": [1]}
+
+    Only book_update events matching a subscribed book id, genre or shelf are sent.
+    """
+    token = websocket.query_params.get("token")
+    if not token:
+        await websocket.close(code=4401)
+        return
+
+    try:
+        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+        if payload.get("role") not in ("member", "admin"):
+            await websocket.close(code=4403)
+            return
+    except JWTError:
+        await websocket.close(code=4401)
+        return
+
+    await book_subscriptions.connect(websocket)
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                # plain text is treated as a keep-alive ping
+                continue
+            try:
+                action = message.get("action")
+                topics = parse_topics(message)
+                if action == "subscribe":
+                    count = book_subscriptions.subscribe(websocket, topics)
+                elif action == "unsubscribe":
+                    count = book_subscriptions.unsubscribe(websocket, topics)
+                else:
+                    raise ValueError("action must be subscribe or unsubscribe")
+            except (ValueError, TypeError, AttributeError) as exc:
+                book_subscriptions.send(websocket, {"event": "error", "detail": str(exc)})
+                continue
+            # replies go through the same queue, so they stay in order with events
+            book_subscriptions.send(websocket, {"event": action + "d", "topics": count})
+    except (WebSocketDisconnect, RuntimeError, KeyError):
+        # RuntimeError/KeyError: the socket was dropped and closed by the manager
+        book_subscriptions.disconnect(websocket)
@@ -1,7 +1,7 @@
-from sqlalchemy import Column, Integer, String, Boolean, Text, Date, ForeignKey, TIMESTAMP
+from sqlalchemy import BigInteger, Column, Integer, SmallInteger, String, Boolean, Text, Date, ForeignKey, TIMESTAMP
 from sqlalchemy.orm import relationship
 from .db import Base
-from datetime import datetime
+from datetime import date, datetime
 
 
 class User(Base):
@@ -41,3 +41,46 @@ class Transaction(Base):
     user = relationship("User")
     book = relationship("Book")
 
+
+class TransactionArchive(Base):
+    """Closed loans moved out of `transactions` by app/archive.py."""
+
+    __tablename__ = "transactions_archive"
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    book_id = Column(Integer, nullable=False)
+    borrow_date = Column(Date, nullable=False)
+    due_date = Column(Date, nullable=False)
+    return_date = Column(Date, nullable=True)
+    status = Column(String(20), nullable=False)
+
+
+class LoanRollup(Base):
+    """Loan counters per day (or month, once compacted) and dimension value, kept by app/analytics.py."""
+
+    __tablename__ = "loan_rollups"
+
+    dimension = Column(String(10), primary_key=True)  # all, genre, author, book, member
+    period = Column(String(5), primary_key=True)  # day or month
+    period_start = Column(Date, primary_key=True)
+    key = Column(Text, primary_key=True)  # genre, author, book id or user id; "" for all
+    # shared counters (all, genre, author) are split over ANALYTICS_SHARDS rows; summed at query time
+    shard = Column(SmallInteger, primary_key=True, default=0, server_default="0")
+    loans = Column(Integer, nullable=False, default=0)
+    returns = Column(Integer, nullable=False, default=0)
+    overdue_returns = Column(Integer, nullable=False, default=0)
+    loan_days = Column(BigInteger, nullable=False, default=0)
+
+
+class Reservation(Base):
+    __tablename__ = "reservations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    book_id = Column(Integer, ForeignKey("books.id"), nullable=False, index=True)
+    reserved_date = Column(Date, nullable=False, default=date.today)
+    notified_at = Column(TIMESTAMP, nullable=True)
+
+    user = relationship("User")
+    book = relationship("Book")
@@ -0,0 +1,347 @@
+"""
+Password hashing.
+
+Hashers are pluggable (PASSWORD_HASHER) with a configurable cost
+(PASSWORD_HASH_COST):
+
+    bcrypt          cost = log2 rounds, default 10 (about 80 ms per hash on one core)
+    pbkdf2_sha256   cost = iterations, default 600000 (standard library only)
+
+Hashes from before this module existed are a single unsalted SHA-256 hex
+digest. They still verify, and needs_rehash() reports them (and hashes made
+with another hasher or cost) so login can upgrade them transparently.
+
+An adaptive hash costs tens of milliseconds of CPU, so the API never hashes
+on the event loop or in the shared anyio threadpool: hash_async() and
+verify_and_update_async() run in a process pool of PASSWORD_HASH_WORKERS
+processes, reniced by PASSWORD_HASH_NICE (0 workers runs them inline, for
+scripts). LoginLimiter caps how many logins wait on that pool at once, so a
+burst at opening time queues (and eventually gets a 503) instead of
+starving catalog traffic.
+
+Bulk imports (POST /users/bulk) hash at the normal cost, spread over every
+pool worker, so their throughput comes from PASSWORD_HASH_WORKERS. A lower
+BULK_PASSWORD_HASH_COST can be opted into for imports that must finish
+faster; those hashes fail needs_rehash() like any other outdated hash, are
+replaced at full cost on the account's first login, and
+`python -m app.bulk_users pending-rehash` lists the accounts still waiting.
+
+This module is imported by the pool's worker processes, so it must not
+import the database or the app.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import bcrypt
+from prometheus_client import Counter, Gauge, Histogram
+
+PASSWORD_HASHER = os.getenv("PASSWORD_HASHER", "bcrypt")
+PASSWORD_HASH_COST = os.getenv("PASSWORD_HASH_COST")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "1"))
+# Workers run at a lower CPU priority so request handling wins when CPU is short
+PASSWORD_HASH_NICE = int(os.getenv("PASSWORD_HASH_NICE", "10"))
+# Logins hashing at the same time; the rest wait in line
+LOGIN_MAX_CONCURRENCY = int(os.getenv("LOGIN_MAX_CONCURRENCY", str(max(1, PASSWORD_HASH_WORKERS) * 2)))
+# Logins allowed to wait; more are rejected with 503 straight away
+LOGIN_MAX_QUEUE = int(os.getenv("LOGIN_MAX_QUEUE", "50"))
+LOGIN_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LOGIN_QUEUE_TIMEOUT_SECONDS", "10"))
+# Opt-in lower cost for passwords set by POST /users/bulk (unset: PASSWORD_HASH_COST);
+# upgraded to PASSWORD_HASH_COST at first login
+BULK_PASSWORD_HASH_COST = os.getenv("BULK_PASSWORD_HASH_COST")
+# Passwords per pool task, so logins get a worker between chunks of a bulk import
+BULK_HASH_CHUNK_SIZE = int(os.getenv("BULK_HASH_CHUNK_SIZE", "4"))
+
+password_hash_duration = Histogram(
+    'lms_password_hash_seconds',
+    'Time to hash or verify a password, including time waiting for a pool worker',
+    ['operation'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+
+password_rehash_counter = Counter(
+    'lms_password_rehash_total',
+    'Stored password hashes upgraded on successful login',
+    ['from_scheme']
+)
+
+login_in_progress = Gauge(
+    'lms_login_in_progress',
+    'Logins currently verifying a password'
+)
+
+login_waiting = Gauge(
+    'lms_login_queue_waiting',
+    'Logins waiting for a free login slot'
+)
+
+login_queue_duration = Histogram(
+    'lms_login_queue_seconds',
+    'Time a login waited for a free login slot',
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+login_rejected_counter = Counter(
+    'lms_login_rejected_total',
+    'Logins rejected with 503 because too many were already queued',
+    ['reason']
+)
+
+
+class BcryptHasher:
+    name = "bcrypt"
+    default_cost = 10
+
+    def __init__(self, cost: int):
+        self.cost = cost
+
+    def identify(self, hashed: str) -> bool:
+        return hashed.startswith(("$2a$", "$2b$", "$2y$"))
+
+    def hash(self, password: str) -> str:
+        # bcrypt only uses the first 72 bytes; newer releases raise instead of truncating
+        return bcrypt.hashpw(password.encode("utf-8")[:72], bcrypt.gensalt(self.cost)).decode("ascii")
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return bcrypt.checkpw(password.encode("utf-8")[:72], hashed.encode("ascii"))
+
+    def cost_of(self, hashed: str) -> int:
+        return int(hashed.split("$")[2])
+
+
+class Pbkdf2Hasher:
+    """Format: $pbkdf2-sha256$<iterations>$<salt>$<digest>, salt and digest urlsafe base64."""
+
+    name = "pbkdf2_sha256"
+    default_cost = 600000
+
+    def __init__(self, cost: int):
+        self.cost = cost
+
+    def identify(self, hashed: str) -> bool:
+        return hashed.startswith("$pbkdf2-sha256$")
+
+    def _digest(self, password: str, salt: bytes, iterations: int) -> str:
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+        return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        encoded_salt = base64.urlsafe_b64encode(salt).decode("ascii").rstrip("=")
+        return f"$pbkdf2-sha256${self.cost}${encoded_salt}${self._digest(password, salt, self.cost)}"
+
+    def verify(self, password: str, hashed: str) -> bool:
+        _, _, iterations, encoded_salt, digest = hashed.split("$")
+        salt = base64.urlsafe_b64decode(encoded_salt + "=" * (-len(encoded_salt) % 4))
+        return hmac.compare_digest(self._digest(password, salt, int(iterations)), digest)
+
+    def cost_of(self, hashed: str) -> int:
+        return int(hashed.split("$")[2])
+
+
+class LegacySha256Hasher:
+    """The original unsalted SHA-256 hex digest. Verify only; never used for new hashes."""
+
+    name = "sha256"
+    pattern = re.compile(r"^[0-9a-f]{64}$")
+
+    def identify(self, hashed: str) -> bool:
+        return bool(self.pattern.match(hashed))
+
+    def verify(self, password: str, hashed: str) -> bool:
+        return hmac.compare_digest(hashlib.sha256(password.encode("utf-8")).hexdigest(), hashed)
+
+
+HASHERS = {hasher.name: hasher for hasher in (BcryptHasher, Pbkdf2Hasher)}
+
+
+def make_hasher(name: str = PASSWORD_HASHER, cost: Optional[str] = PASSWORD_HASH_COST):
+    if name not in HASHERS:
+        raise ValueError(f"Unknown PASSWORD_HASHER {name!r}, expected one of {sorted(HASHERS)}")
+    hasher_class = HASHERS[name]
+    return hasher_class(int(cost) if cost else hasher_class.default_cost)
+
+
+hasher = make_hasher()
+bulk_hasher = make_hasher(hasher.name, BULK_PASSWORD_HASH_COST) if BULK_PASSWORD_HASH_COST else hasher
+KNOWN_HASHERS = [hasher] + [cls(cls.default_cost) for name, cls in HASHERS.items() if name != hasher.name] + [LegacySha256Hasher()]
+
+
+def identify(hashed: str):
+    for candidate in KNOWN_HASHERS:
+        if candidate.identify(hashed):
+            return candidate
+    return None
+
+
+def hash_password(password: str) -> str:
+    return hasher.hash(password)
+
+
+def hash_passwords_bulk(passwords: List[str]) -> List[str]:
+    return [bulk_hasher.hash(password) for password in passwords]
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    scheme = identify(hashed)
+    if scheme is None:
+        return False
+    try:
+        return scheme.verify(password, hashed)
+    except ValueError:
+        # a malformed stored hash (e.g. bcrypt "Invalid salt") is a failed login, not a 500
+        return False
+
+
+def needs_rehash(hashed: str) -> bool:
+    scheme = identify(hashed)
+    return scheme is None or scheme.name != hasher.name or scheme.cost_of(hashed) != hasher.cost
+
+
+def verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """Verify, and if the stored hash is outdated return a new one to store as well."""
+    if not verify_password(password, hashed):
+        return False, None
+    if needs_rehash(hashed):
+        return True, hasher.hash(password)
+    return True, None
+
+
+# ---------- process pool ----------
+
+
+def _init_worker(niceness: int):
+    if niceness and hasattr(os, "nice"):
+        os.nice(niceness)
+
+
+class HashPool:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self.workers > 0 and self.executor is None:
+            # spawn, not fork: the API process has running threads and an event loop
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(PASSWORD_HASH_NICE,),
+            )
+
+    async def run(self, operation: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return fn(*args)
+            self.start()
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            password_hash_duration.labels(operation=operation).observe(time.perf_counter() - start)
+
+    async def warm_up(self):
+        """Start every worker process now rather than on the first logins."""
+        if self.workers > 0:
+            await asyncio.gather(*(self.run("warm_up", identify, "") for _ in range(self.workers)))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+hash_pool = HashPool()
+
+
+async def hash_async(password: str) -> str:
+    return await hash_pool.run("hash", hash_password, password)
+
+
+async def hash_many_async(passwords: List[str], chunk_size: int = BULK_HASH_CHUNK_SIZE) -> List[str]:
+    """Hash at the bulk cost (normally the login cost), spread over the pool in chunks of chunk_size."""
+    chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+    hashed = await asyncio.gather(*(hash_pool.run("bulk_hash", hash_passwords_bulk, chunk) for chunk in chunks))
+    return [value for chunk in hashed for value in chunk]
+
+
+async def verify_and_update_async(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return await hash_pool.run("verify", verify_and_update, password, hashed)
+
+
+_dummy_hash: Optional[str] = None
+
+
+async def dummy_hash_async() -> str:
+    """
+    A hash at the current cost that no password matches. Login verifies
+    against it when the username does not exist, so an unknown username takes
+    as long as a wrong password and usernames cannot be probed by timing.
+    """
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_async(base64.b64encode(os.urandom(16)).decode("ascii"))
+    return _dummy_hash
+
+
+# ---------- login concurrency cap ----------
+
+
+class LoginOverloaded(Exception):
+    pass
+
+
+class LoginLimiter:
+    """At most max_concurrency logins hash at once, at most max_queue wait, each for at most timeout."""
+
+    def __init__(
+        self,
+        max_concurrency: int = LOGIN_MAX_CONCURRENCY,
+        max_queue: int = LOGIN_MAX_QUEUE,
+        timeout: float = LOGIN_QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.waiting = 0
+        self.active = 0
+
+    async def __aenter__(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            login_rejected_counter.labels(reason="queue_full").inc()
+            raise LoginOverloaded()
+        self.waiting += 1
+        login_waiting.set(self.waiting)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            login_rejected_counter.labels(reason="timeout").inc()
+            raise LoginOverloaded()
+        finally:
+            self.waiting -= 1
+            login_waiting.set(self.waiting)
+            login_queue_duration.observe(time.perf_counter() - start)
+        self.active += 1
+        login_in_progress.set(self.active)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        login_in_progress.set(self.active)
+        self.semaphore.release()
+
+
+login_limiter = LoginLimiter()
+
+
+def record_rehash(old_hash: str):
+    scheme = identify(old_hash)
+    password_rehash_counter.labels(from_scheme=scheme.name if scheme else "unknown").inc()
@@ -0,0 +1,262 @@
+"""
+On-demand sampling profiler for live requests.
+
+GET /admin/profile?seconds=N starts a session: a background thread samples
+the Python stacks of every thread (sys._current_frames) at a fixed interval.
+Without a route every stack that is not idle (event loop in select, worker
+threads waiting for work) is kept; with a route only stacks running that
+route's endpoint function are kept. A sample fraction below 1 picks that
+share of requests once, in ProfilingMiddleware, and the sampler keeps only
+stacks of threads serving one of those requests, so the flame graph and the
+SQL numbers describe the same requests. At the same time SQLAlchemy cursor
+events record SQL time for the requests being profiled, so the output can
+say how much of the profiled request time was spent in the database.
+
+Which request a thread is serving is read from its stack: on the event loop
+thread the ProfilingMiddleware frame of the running request is on it, and a
+worker thread runs sync code inside the request's copied contextvars.Context
+(held by anyio's worker loop as `context`), where _sql_time is set only for
+sampled requests.
+
+When no session is running, the only cost is one attribute check per
+request in ProfilingMiddleware: the sampler thread and SQL listeners only
+exist during a session.
+"""
+import contextvars
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", "0.005"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_MAX_DEPTH = 128
+
+# Mutable [sql_seconds, statements] shared by every thread hop of a profiled request
+_sql_time: contextvars.ContextVar = contextvars.ContextVar("profile_sql_time", default=None)
+
+Frame = Tuple[str, str, int]
+
+# Innermost frames of a thread with nothing to do
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def _frame_key(frame) -> Frame:
+    code = frame.f_code
+    filename = code.co_filename
+    for marker in ("site-packages" + os.sep, "app" + os.sep):
+        idx = filename.rfind(marker)
+        if idx != -1:
+            filename = filename[idx:]
+            break
+    return code.co_name, filename, code.co_firstlineno
+
+
+class ProfileSession:
+    def __init__(self, endpoint_codes: Optional[Set], route: Optional[str], sample: float, interval: float):
+        self.endpoint_codes = endpoint_codes
+        self.route = route
+        self.sample = sample
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.sql_seconds = 0.0
+        self.sql_statements = 0
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.stop_event = threading.Event()
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.session: Optional[ProfileSession] = None
+        self.engine: Optional[Engine] = None
+
+    @property
+    def active(self) -> bool:
+        return self.session is not None
+
+    def start(self, engine: Engine, endpoint_codes: Optional[Set], route: Optional[str], sample: float):
+        """endpoint_codes=None samples every busy thread, otherwise only stacks running those endpoints."""
+        if self.session is not None:
+            raise RuntimeError("A profiling session is already running")
+        self.session = ProfileSession(endpoint_codes, route, sample, self.interval)
+        self.engine = engine
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        thread = threading.Thread(target=self._run, args=(self.session,), name="lms-profiler", daemon=True)
+        thread.start()
+
+    def stop(self) -> ProfileSession:
+        session = self.session
+        session.stop_event.set()
+        session.duration = time.perf_counter() - session.started
+        event.remove(self.engine, "before_cursor_execute", _before_cursor_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_cursor_execute)
+        self.session = None
+        self.engine = None
+        return session
+
+    def _run(self, session: ProfileSession):
+        own_id = threading.get_ident()
+        codes = session.endpoint_codes
+        while not session.stop_event.wait(session.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if codes is None and frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack: List[Frame] = []
+                serving = codes is None
+                # with sample < 1, only threads serving a request picked by ProfilingMiddleware
+                sampled = session.sample >= 1
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    if not serving and frame.f_code in codes:
+                        serving = True
+                    if not sampled:
+                        sampled = _serves_sampled_request(frame)
+                    stack.append(_frame_key(frame))
+                    frame = frame.f_back
+                if not serving or not sampled:
+                    continue
+                stack.reverse()
+                session.stacks[tuple(stack)] += 1
+                session.samples += 1
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("profile_query_start")
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        sql_time = _sql_time.get()
+        if sql_time is not None:
+            sql_time[0] += elapsed
+            sql_time[1] += 1
+
+
+def _serves_sampled_request(frame) -> bool:
+    """True if frame shows its thread is running code of a request ProfilingMiddleware sampled."""
+    code = frame.f_code
+    if code is _MIDDLEWARE_CODE:
+        return frame.f_locals.get("sql_time") is not None
+    if code.co_name == "run":
+        context = frame.f_locals.get("context")
+        if isinstance(context, contextvars.Context):
+            return context.get(_sql_time) is not None
+    return False
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware that tracks SQL and wall time of requests being profiled."""
+
+    def __init__(self, app, profiler: "SamplingProfiler" = None):
+        self.app = app
+        self.profiler = profiler or sampling_profiler
+
+    async def __call__(self, scope, receive, send):
+        session = self.profiler.session
+        if session is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # the only sampling draw: the stack sampler keeps threads serving these requests
+        if session.sample < 1 and random.random() >= session.sample:
+            await self.app(scope, receive, send)
+            return
+
+        sql_time = [0.0, 0]
+        token = _sql_time.set(sql_time)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _sql_time.reset(token)
+            route = scope.get("route")
+            if route is not None and session.route in (None, route.path) and route.path != "/admin/profile":
+                session.requests += 1
+                session.request_seconds += time.perf_counter() - start
+                session.sql_seconds += sql_time[0]
+                session.sql_statements += sql_time[1]
+
+
+_MIDDLEWARE_CODE = ProfilingMiddleware.__call__.__code__
+
+
+def summary(session: ProfileSession) -> Dict:
+    return {
+        "route": session.route or "all",
+        "sample": session.sample,
+        "duration_seconds": round(session.duration, 3),
+        "interval_seconds": session.interval,
+        "samples": session.samples,
+        "requests": session.requests,
+        "request_seconds": round(session.request_seconds, 6),
+        "sql_seconds": round(session.sql_seconds, 6),
+        "sql_statements": session.sql_statements,
+        "sql_fraction": round(session.sql_seconds / session.request_seconds, 4) if session.request_seconds else 0.0,
+    }
+
+
+def to_collapsed(session: ProfileSession) -> str:
+    """Brendan Gregg's collapsed stack format, one 'frame;frame;frame count' line per stack."""
+    lines = []
+    for stack, count in session.stacks.most_common():
+        frames = ";".join(f"{name} ({filename}:{line})" for name, filename, line in stack)
+        lines.append(f"{frames} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(session: ProfileSession) -> Dict:
+    """speedscope.app file format (sampled profile)."""
+    info = summary(session)
+    frames: List[Dict] = []
+    frame_index: Dict[Frame, int] = {}
+    samples: List[List[int]] = []
+    weights: List[float] = []
+    for stack, count in session.stacks.items():
+        indexes = []
+        for key in stack:
+            if key not in frame_index:
+                frame_index[key] = len(frames)
+                frames.append({"name": key[0], "file": key[1], "line": key[2]})
+            indexes.append(frame_index[key])
+        samples.append(indexes)
+        weights.append(count * session.interval)
+
+    name = (
+        f"{info['route']}: {info['requests']} requests, "
+        f"{info['request_seconds']:.3f}s request time, "
+        f"{info['sql_seconds']:.3f}s SQL ({info['sql_fraction']:.0%})"
+    )
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "lms-api",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }
+        ],
+    }
+
+
+sampling_profiler = SamplingProfiler()
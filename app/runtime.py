@@ -0,0 +1,219 @@
+"""
+Runtime saturation signals.
+
+Most endpoints are plain `def` functions that FastAPI runs in the anyio
+worker threadpool, and each of them then needs a connection from the
+SQLAlchemy pool. When either pool is exhausted requests queue silently, so
+this module exports:
+
+    lms_event_loop_lag_seconds            how late the event loop runs a ready task
+    lms_threadpool_tokens_*               worker threads configured / in use / waited for
+    lms_threadpool_queue_seconds          time from request arrival to first thread
+    lms_db_pool_wait_seconds              time waiting for a DB connection
+    lms_gc_pause_seconds                  garbage collector pauses
+
+The loop lag and pool wait are also read by the admission controller.
+"""
+import asyncio
+import contextvars
+import gc
+import os
+import time
+from typing import Optional
+
+import anyio.to_thread
+from prometheus_client import Counter, Gauge, Histogram
+
+LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("LOOP_LAG_INTERVAL_SECONDS", "0.1"))
+# anyio's default is 40 worker threads
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+event_loop_lag = Gauge(
+    'lms_event_loop_lag_seconds',
+    'How late the event loop woke up a sleeping task (latest sample)'
+)
+
+event_loop_lag_histogram = Histogram(
+    'lms_event_loop_lag_distribution_seconds',
+    'Distribution of event loop lag samples',
+    buckets=LATENCY_BUCKETS
+)
+
+db_pool_wait = Histogram(
+    'lms_db_pool_wait_seconds',
+    'Time a request waited to check out a connection from the DB pool',
+    buckets=LATENCY_BUCKETS
+)
+
+db_pool_checked_out = Gauge(
+    'lms_db_pool_connections_checked_out',
+    'DB pool connections currently in use'
+)
+
+db_pool_capacity = Gauge(
+    'lms_db_pool_connections_max',
+    'DB pool size plus max overflow'
+)
+
+threadpool_tokens_total = Gauge(
+    'lms_threadpool_tokens_total',
+    'Worker threads available to sync endpoints and dependencies'
+)
+
+threadpool_tokens_in_use = Gauge(
+    'lms_threadpool_tokens_in_use',
+    'Worker threads currently running sync endpoints and dependencies'
+)
+
+threadpool_waiting = Gauge(
+    'lms_threadpool_waiting_tasks',
+    'Tasks waiting for a free worker thread'
+)
+
+threadpool_queue = Histogram(
+    'lms_threadpool_queue_seconds',
+    'Time from request arrival until its first sync code ran in a worker thread',
+    buckets=LATENCY_BUCKETS
+)
+
+gc_pause = Histogram(
+    'lms_gc_pause_seconds',
+    'Garbage collector pause duration',
+    ['generation'],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+)
+
+gc_collected = Counter(
+    'lms_gc_collected_objects_total',
+    'Objects collected by the garbage collector',
+    ['generation']
+)
+
+
+class LoopLagMonitor:
+    """Sleeps for a fixed interval and records how much later than asked it woke up."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            event_loop_lag.set(self.lag)
+            event_loop_lag_histogram.observe(self.lag)
+
+
+class PoolWaitTracker:
+    """
+    Exponentially weighted average of recent DB pool checkout waits.
+
+    Observations older than `stale_after` seconds count as no wait, so the
+    signal recovers once the pool stops being used.
+    """
+
+    def __init__(self, alpha: float = 0.2, stale_after: float = 5.0):
+        self.alpha = alpha
+        self.stale_after = stale_after
+        self.average = 0.0
+        self.last_observed = 0.0
+
+    def observe(self, seconds: float):
+        self.average = self.alpha * seconds + (1 - self.alpha) * self.average
+        self.last_observed = time.monotonic()
+        db_pool_wait.observe(seconds)
+
+    @property
+    def recent(self) -> float:
+        if time.monotonic() - self.last_observed > self.stale_after:
+            return 0.0
+        return self.average
+
+
+class GCPauseTimer:
+    """gc.callbacks hook timing every collection."""
+
+    def __init__(self):
+        self.started: Optional[float] = None
+
+    def __call__(self, phase: str, info: dict):
+        if phase == "start":
+            self.started = time.perf_counter()
+        elif self.started is not None:
+            generation = str(info.get("generation"))
+            gc_pause.labels(generation=generation).observe(time.perf_counter() - self.started)
+            gc_collected.labels(generation=generation).inc(info.get("collected", 0))
+            self.started = None
+
+    def install(self):
+        if self not in gc.callbacks:
+            gc.callbacks.append(self)
+
+
+# [arrival time, already measured] for the current request. A list, because
+# anyio copies the context into each worker thread and only a shared mutable
+# object lets the first thread hop mark the request as measured.
+_request_arrival: contextvars.ContextVar = contextvars.ContextVar("request_arrival", default=None)
+
+
+class ThreadpoolQueueMiddleware:
+    """Pure ASGI middleware recording when each HTTP request arrived."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_arrival.set([time.perf_counter(), False])
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_arrival.reset(token)
+
+
+def mark_thread_start():
+    """
+    Called from sync code running in a worker thread (get_db). Observes the
+    time the request waited for its first worker thread.
+    """
+    arrival = _request_arrival.get()
+    if arrival is None or arrival[1]:
+        return
+    arrival[1] = True
+    threadpool_queue.observe(time.perf_counter() - arrival[0])
+
+
+def configure_threadpool(size: int = THREADPOOL_SIZE):
+    """Set the anyio worker thread limit. Must run inside the event loop (startup)."""
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = size
+    threadpool_tokens_total.set_function(lambda: limiter.total_tokens)
+    threadpool_tokens_in_use.set_function(lambda: limiter.borrowed_tokens)
+    threadpool_waiting.set_function(lambda: limiter.statistics().tasks_waiting)
+    return limiter
+
+
+def check_pool_sizes(threadpool_size: int, db_capacity: int):
+    """
+    Warn when more worker threads can run DB code than the DB pool has
+    connections. (A smaller threadpool is fine: async endpoints such as
+    /borrow also use the pool from the event loop thread.)
+    """
+    if threadpool_size > db_capacity:
+        print(
+            f"WARNING: threadpool size {threadpool_size} is larger than DB pool capacity "
+            f"{db_capacity} (DB_POOL_SIZE + DB_MAX_OVERFLOW). Threads will queue on the "
+            f"DB pool; see lms_db_pool_wait_seconds."
+        )
+
+
+loop_lag_monitor = LoopLagMonitor()
+pool_wait_tracker = PoolWaitTracker()
+gc_pause_timer = GCPauseTimer()
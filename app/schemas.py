@@ -1,6 +1,6 @@
 from pydantic import BaseModel
-from typing import Optional
-from datetime import date
+from typing import List, Optional
+from datetime import date, datetime
 from pydantic import BaseModel
 
 class UserBase(BaseModel):
@@ -68,6 +68,21 @@ class ReturnRequest(BaseModel):
     book_id: int
     
 
+class ReservationCreate(BaseModel):
+    book_id: int
+
+
+class ReservationOut(BaseModel):
+    id: int
+    user_id: int
+    book_id: int
+    reserved_date: date
+    notified_at: datetime | None
+
+    class Config:
+        from_attributes = True
+
+
 class TransactionOut(BaseModel):
     id: int
     user_id: int
@@ -90,3 +105,27 @@ class AdminTransactionOut(BaseModel):
     due_date: date
     return_date: date | None
     status: str
+
+
+class AvailableBooksOut(BaseModel):
+    genre: Optional[str] = None
+    shelf: Optional[str] = None
+    count: int
+    book_ids: List[int]
+
+
+class AnalyticsRowOut(BaseModel):
+    key: str
+    label: Optional[str] = None
+    loans: int
+    returns: int
+    overdue_returns: int
+    average_loan_days: Optional[float] = None
+    overdue_rate: Optional[float] = None
+
+
+class AnalyticsOut(BaseModel):
+    report: str
+    start: date
+    end: date
+    rows: List[AnalyticsRowOut]
@@ -0,0 +1,736 @@
+"""
+Microbenchmarks for the API's hot paths, run in-process against a local database.
+
+For every benchmark it reports:
+    median_us / min_us   time per call (median and best of --repeats timed runs)
+    sql                  SQL statements per call
+    alloc_peak_kib       peak memory allocated during one call (tracemalloc)
+    alloc_blocks         memory blocks still allocated after one call (tracemalloc)
+
+Usage:
+    # against a throwaway database; the dataset is created if the books table is empty
+    DATABASE_URL=sqlite:///bench.db python benchmark.py
+    DB_NAME=lms_bench python benchmark.py --save baseline
+    DB_NAME=lms_bench python benchmark.py --compare baseline --threshold 0.2
+    DATABASE_URL=sqlite:///bench.db python benchmark.py --filter crud. --filter auth.
+    DB_NAME=lms_bench python benchmark.py --history-growth
+
+Baselines are stored in benchmarks/<name>.json. --compare exits with status 1
+when any benchmark got slower or allocates more than --threshold (a fraction),
+or runs more SQL statements than its baseline.
+
+--history-growth grows transactions_archive to 1x, 10x and 100x the live
+transaction count and times the hot-path queries at each size; they should
+stay flat while the history query grows.
+
+The database must be named explicitly (DATABASE_URL or DB_NAME); the script
+refuses to fall back to the app's defaults. Benchmark rows are created with
+"bench_" usernames and BENCH- ISBNs. Loans written by the borrow/return
+benchmarks (all by bench_member2) are deleted again at the end, and their
+analytics counters subtracted, so rows of other users are never touched.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+
+# The benchmarks write to the database and delete their rows again; never let
+# them fall back to the app's default database settings
+if not (os.getenv("DATABASE_URL") or os.getenv("DB_NAME")):
+    sys.exit(
+        "benchmark.py writes to the database it runs against. Name a throwaway database "
+        "explicitly with DATABASE_URL (e.g. sqlite:///bench.db) or DB_NAME (e.g. lms_bench)."
+    )
+
+# Benchmarks measure the code, not the load shedding in front of it
+os.environ.setdefault("ADMISSION_ENABLED", "false")
+os.environ.setdefault("AVAILABILITY_INDEX_REFRESH_SECONDS", "0")
+
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter
+from sqlalchemy import event, func, select
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app import analytics, auth, crud, models, schemas
+from app.db import SessionLocal, engine
+from app.main import ConnectionManager, app, is_suspicious_request, metrics_middleware
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+BENCH_BOOKS = 500
+BENCH_MEMBERS = 20
+BENCH_TRANSACTIONS = 2000
+WS_SOCKETS = 100
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return register
+
+
+# ---------- dataset ----------
+
+
+def ensure_dataset():
+    rng = random.Random(42)
+    db = SessionLocal()
+    try:
+        password_hash = None
+        for username, role in [("bench_admin", "admin")] + [(f"bench_member{i}", "member") for i in range(1, BENCH_MEMBERS + 1)]:
+            if db.query(models.User).filter_by(username=username).first() is None:
+                password_hash = password_hash or auth.get_password_hash("bench123")
+                db.add(models.User(username=username, password_hash=password_hash, role=role))
+        db.commit()
+
+        if db.query(models.Book).count() == 0:
+            print(f"Creating benchmark dataset: {BENCH_BOOKS} books, {BENCH_TRANSACTIONS} transactions")
+            genres = ["Fiction", "Science", "History", "Children", "Poetry", "Travel"]
+            db.add_all(
+                models.Book(
+                    title=f"Benchmark Book {i}",
+                    author=f"Author {i % 50}",
+                    isbn=f"BENCH-{i:06d}",
+                    genre=genres[i % len(genres)],
+                    shelf_location=f"S{i % 20}",
+                    available=True,
+                )
+                for i in range(BENCH_BOOKS)
+            )
+            db.commit()
+            book_ids = [b.id for b in db.query(models.Book.id)]
+            member_ids = [u.id for u in db.query(models.User.id).filter(models.User.username.like("bench_member%"))]
+            today = date.today()
+            transactions = []
+            for _ in range(BENCH_TRANSACTIONS):
+                borrowed = today - timedelta(days=rng.randint(15, 365))
+                returned = borrowed + timedelta(days=rng.randint(1, 20))
+                transactions.append(
+                    models.Transaction(
+                        user_id=rng.choice(member_ids),
+                        book_id=rng.choice(book_ids),
+                        borrow_date=borrowed,
+                        due_date=borrowed + timedelta(days=14),
+                        return_date=returned,
+                        status="returned" if returned <= borrowed + timedelta(days=14) else "overdue",
+                    )
+                )
+            db.add_all(transactions)
+            db.commit()
+        if db.query(models.LoanRollup).first() is None:
+            analytics.rebuild(db)
+    finally:
+        db.close()
+
+
+class Context:
+    """Ids, tokens and clients shared by the benchmarks."""
+
+    def __init__(self):
+        db = SessionLocal()
+        try:
+            admin = db.query(models.User).filter_by(username="bench_admin").one()
+            self.member = db.query(models.User).filter_by(username="bench_member1").one()
+            # a different member, so borrow/return rows do not grow the member's listed history
+            self.borrower = db.query(models.User).filter_by(username="bench_member2").one()
+            self.book_id = db.query(models.Book.id).order_by(models.Book.id).first()[0]
+            self.free_book_id = (
+                db.query(models.Book.id).filter(models.Book.available.is_(True)).order_by(models.Book.id.desc()).first()[0]
+            )
+            self.max_transaction_id = db.query(func.max(models.Transaction.id)).scalar() or 0
+            self.dataset = {
+                "books": db.query(models.Book).count(),
+                "users": db.query(models.User).count(),
+                "transactions": db.query(models.Transaction).count(),
+            }
+            self.books = crud.list_books(db)
+            self.admin_rows = crud.list_transactions_admin(db)
+        finally:
+            db.close()
+        self.member_token = auth.create_access_token({"sub": self.member.username, "role": "member"})
+        self.borrower_token = auth.create_access_token({"sub": self.borrower.username, "role": "member"})
+        self.admin_token = auth.create_access_token({"sub": admin.username, "role": "admin"})
+        self.client = None
+
+    def cleanup(self):
+        """
+        Delete the loans written by the benchmarks (only the borrower's, made
+        since the start), subtract them from the analytics counters and make
+        the borrowed book available again.
+        """
+        db = SessionLocal()
+        try:
+            written = db.query(models.Transaction).filter(
+                models.Transaction.id > self.max_transaction_id,
+                models.Transaction.user_id == self.borrower.id,
+            ).all()
+            books = {book.id: book for book in db.query(models.Book).filter(
+                models.Book.id.in_({tx.book_id for tx in written})
+            )}
+            for tx in written:
+                book = books.get(tx.book_id)
+                analytics.record(db, tx.borrow_date, tx.user_id, tx.book_id, book, loans=-1)
+                if tx.return_date is not None:
+                    analytics.record(
+                        db, tx.return_date, tx.user_id, tx.book_id, book,
+                        returns=-1,
+                        overdue_returns=-int(tx.status == "overdue"),
+                        loan_days=-(tx.return_date - tx.borrow_date).days,
+                    )
+                db.delete(tx)
+            # rows that only held the benchmark's counts would now be all zero
+            days = {tx.borrow_date for tx in written} | {tx.return_date for tx in written if tx.return_date}
+            if days:
+                rollups = models.LoanRollup
+                db.query(rollups).filter(
+                    rollups.period == "day",
+                    rollups.period_start.in_(days),
+                    *(getattr(rollups, name) == 0 for name in analytics.COUNTERS),
+                ).delete(synchronize_session=False)
+            still_borrowed = db.query(models.Transaction.id).filter(
+                models.Transaction.book_id == self.free_book_id,
+                models.Transaction.status == "borrowed",
+            ).first()
+            if still_borrowed is None:
+                db.query(models.Book).filter(models.Book.id == self.free_book_id).update({"available": True})
+            db.commit()
+        finally:
+            db.close()
+
+
+class FakeWebSocket:
+    async def send_text(self, text):
+        pass
+
+
+# ---------- crud (a fresh session per call, like a request) ----------
+
+
+@benchmark("crud.list_books")
+def bench_list_books(ctx):
+    with SessionLocal() as db:
+        crud.list_books(db)
+
+
+@benchmark("crud.get_book")
+def bench_get_book(ctx):
+    with SessionLocal() as db:
+        crud.get_book(db, ctx.book_id)
+
+
+@benchmark("crud.list_transactions_for_user")
+def bench_list_transactions_for_user(ctx):
+    with SessionLocal() as db:
+        crud.list_transactions_for_user(db, ctx.member.id)
+
+
+@benchmark("crud.list_transactions_for_user.history")
+def bench_list_transactions_for_user_history(ctx):
+    with SessionLocal() as db:
+        crud.list_transactions_for_user(db, ctx.member.id, include_history=True)
+
+
+@benchmark("crud.list_transactions_admin")
+def bench_list_transactions_admin(ctx):
+    with SessionLocal() as db:
+        crud.list_transactions_admin(db)
+
+
+@benchmark("crud.list_transactions_admin.unreturned")
+def bench_list_transactions_admin_unreturned(ctx):
+    with SessionLocal() as db:
+        crud.list_transactions_admin(db, unreturned_only=True)
+
+
+@benchmark("crud.borrow_return")
+def bench_borrow_return(ctx):
+    with SessionLocal() as db:
+        crud.borrow_book(db, ctx.borrower.id, ctx.free_book_id)
+        crud.return_book(db, ctx.borrower.id, ctx.free_book_id)
+
+
+@benchmark("analytics.summary.365_days")
+def bench_analytics_summary(ctx):
+    with SessionLocal() as db:
+        analytics.totals(db, "all", date.today() - timedelta(days=364), date.today())
+
+
+@benchmark("analytics.top_titles.365_days")
+def bench_analytics_top_titles(ctx):
+    with SessionLocal() as db:
+        analytics.totals(db, "book", date.today() - timedelta(days=364), date.today(), limit=10)
+
+
+@benchmark("analytics.overdue_rate.365_days")
+def bench_analytics_overdue_rate(ctx):
+    with SessionLocal() as db:
+        analytics.totals(
+            db, "member", date.today() - timedelta(days=364), date.today(), limit=20, by_overdue_rate=True
+        )
+
+
+# ---------- serialization ----------
+
+book_list_adapter = TypeAdapter(list[schemas.BookOut])
+admin_transactions_adapter = TypeAdapter(list[schemas.AdminTransactionOut])
+
+
+@benchmark("serialize.book_list")
+def bench_serialize_books(ctx):
+    book_list_adapter.dump_json(book_list_adapter.validate_python(ctx.books, from_attributes=True))
+
+
+@benchmark("serialize.admin_transactions")
+def bench_serialize_admin_transactions(ctx):
+    admin_transactions_adapter.dump_json(admin_transactions_adapter.validate_python(ctx.admin_rows))
+
+
+# ---------- auth ----------
+
+
+@benchmark("auth.get_current_user")
+async def bench_get_current_user(ctx):
+    with SessionLocal() as db:
+        await auth.get_current_user(ctx.member_token, db)
+
+
+@benchmark("auth.create_access_token")
+def bench_create_access_token(ctx):
+    auth.create_access_token({"sub": "bench_member1", "role": "member"})
+
+
+# ---------- middleware ----------
+
+
+def http_scope(path):
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "headers": [(b"host", b"testserver")],
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 50000),
+    }
+
+
+async def ok_response(request):
+    return Response(b"{}", media_type="application/json")
+
+
+@benchmark("middleware.metrics")
+async def bench_metrics_middleware(ctx):
+    await metrics_middleware(Request(http_scope("/books/1")), ok_response)
+
+
+@benchmark("middleware.metrics.suspicious")
+async def bench_metrics_middleware_suspicious(ctx):
+    await metrics_middleware(Request(http_scope("/wp-admin/setup-config.php")), ok_response)
+
+
+@benchmark("middleware.is_suspicious_request.legit")
+def bench_is_suspicious_legit(ctx):
+    is_suspicious_request("/books/42")
+
+
+@benchmark("middleware.is_suspicious_request.attack")
+def bench_is_suspicious_attack(ctx):
+    is_suspicious_request("/cgi-bin/../../etc/passwd")
+
+
+@benchmark("middleware.is_suspicious_request.unknown")
+def bench_is_suspicious_unknown(ctx):
+    is_suspicious_request("/some/unknown/path")
+
+
+# ---------- websocket broadcast ----------
+
+
+async def ws_manager(window_ms):
+    manager = ConnectionManager(coalesce_window_ms=window_ms)
+    for _ in range(WS_SOCKETS):
+        websocket = FakeWebSocket()
+        manager.outgoing.add(websocket)
+        manager.active_connections.append(websocket)
+    return manager
+
+
+async def delivered(manager):
+    """Wait until every socket's sender task has sent its queued frames."""
+    await asyncio.gather(*(queue.join() for queue in manager.outgoing.queues.values()))
+
+
+@benchmark(f"ws.broadcast.{WS_SOCKETS}_sockets")
+async def bench_broadcast(ctx):
+    manager = ctx.ws_immediate
+    await manager.broadcast({"event": "book_update", "book_id": ctx.book_id, "available": True})
+    await delivered(manager)
+
+
+@benchmark(f"ws.broadcast.coalesced_10_events.{WS_SOCKETS}_sockets")
+async def bench_broadcast_coalesced(ctx):
+    manager = ctx.ws_coalesced
+    for book_id in range(10):
+        await manager.broadcast({"event": "book_update", "book_id": book_id, "available": True})
+    manager.flush_task.cancel()
+    await manager.flush()
+    await delivered(manager)
+
+
+# ---------- whole requests through the in-process app ----------
+
+
+@benchmark("http.GET /books/")
+def bench_http_books(ctx):
+    ctx.client.get("/books/")
+
+
+@benchmark("http.GET /books/{id}")
+def bench_http_book(ctx):
+    ctx.client.get(f"/books/{ctx.book_id}")
+
+
+@benchmark("http.GET /admin/transactions")
+def bench_http_admin_transactions(ctx):
+    ctx.client.get("/admin/transactions", headers={"Authorization": f"Bearer {ctx.admin_token}"})
+
+
+@benchmark("http.POST /borrow + /return")
+def bench_http_borrow_return(ctx):
+    headers = {"Authorization": f"Bearer {ctx.borrower_token}"}
+    ctx.client.post("/borrow", json={"book_id": ctx.free_book_id}, headers=headers)
+    ctx.client.post("/return", json={"book_id": ctx.free_book_id}, headers=headers)
+
+
+# ---------- runner ----------
+
+
+class Runner:
+    def __init__(self, ctx, loop, min_time, repeats):
+        self.ctx = ctx
+        self.loop = loop
+        self.min_time = min_time
+        self.repeats = repeats
+        self.statements = 0
+        event.listen(engine, "before_cursor_execute", self.count_statement)
+
+    def count_statement(self, *args):
+        self.statements += 1
+
+    def call(self, fn, number):
+        """Run fn `number` times and return the elapsed seconds."""
+        ctx = self.ctx
+        if asyncio.iscoroutinefunction(fn):
+            async def many():
+                start = time.perf_counter()
+                for _ in range(number):
+                    await fn(ctx)
+                return time.perf_counter() - start
+            return self.loop.run_until_complete(many())
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(ctx)
+        return time.perf_counter() - start
+
+    def run(self, fn):
+        # warm up caches (SQLAlchemy compiled statements, pydantic validators)
+        self.call(fn, 3)
+
+        # iterations per timed run, so that a run takes about min_time
+        number = 1
+        while True:
+            elapsed = self.call(fn, number)
+            if elapsed >= self.min_time / 5 or number >= 1_000_000:
+                break
+            number *= 10
+        number = max(1, int(number * self.min_time / max(elapsed, 1e-9)))
+        timings = [self.call(fn, number) / number for _ in range(self.repeats)]
+
+        before = self.statements
+        self.call(fn, 10)
+        sql = (self.statements - before) / 10
+
+        peaks = []
+        blocks = []
+        tracemalloc.start()
+        try:
+            for _ in range(5):
+                start_blocks = traced_blocks()
+                tracemalloc.reset_peak()
+                start_size, _ = tracemalloc.get_traced_memory()
+                self.call(fn, 1)
+                _, peak = tracemalloc.get_traced_memory()
+                end_blocks = traced_blocks()
+                peaks.append(peak - start_size)
+                blocks.append(end_blocks - start_blocks)
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "median_us": round(statistics.median(timings) * 1e6, 3),
+            "min_us": round(min(timings) * 1e6, 3),
+            "iterations": number,
+            "sql": round(sql, 2),
+            "alloc_peak_kib": round(statistics.median(peaks) / 1024, 2),
+            "alloc_blocks": int(statistics.median(blocks)),
+        }
+
+
+def traced_blocks():
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmarks(args):
+    ensure_dataset()
+    ctx = Context()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    ctx.ws_immediate = loop.run_until_complete(ws_manager(0))
+    ctx.ws_coalesced = loop.run_until_complete(ws_manager(50))
+    runner = Runner(ctx, loop, args.min_time, args.repeats)
+
+    selected = [
+        (name, fn) for name, fn in BENCHMARKS
+        if not args.filter or any(name.startswith(prefix) for prefix in args.filter)
+    ]
+    results = {}
+    try:
+        with TestClient(app) as client:
+            ctx.client = client
+            for name, fn in selected:
+                results[name] = runner.run(fn)
+                r = results[name]
+                print(
+                    f"{name:<52} {r['median_us']:>12.1f} us  {r['sql']:>5g} sql  "
+                    f"{r['alloc_peak_kib']:>9.1f} KiB peak  {r['alloc_blocks']:>6} blocks"
+                )
+    finally:
+        ctx.cleanup()
+        loop.close()
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": machine(),
+        "database": engine.dialect.name,
+        "dataset": ctx.dataset,
+        "benchmarks": results,
+    }
+
+
+# Archived rows added by --history-growth get ids from here up and are deleted afterwards
+GROWTH_ID_BASE = 1_000_000_000
+HISTORY_GROWTH_FACTORS = (1, 10, 100)
+# Benchmarks that must not slow down as the archive grows, plus one that reads it for contrast
+HOT_PATH_BENCHMARKS = (
+    "crud.list_transactions_for_user",
+    "crud.list_transactions_admin.unreturned",
+    "crud.borrow_return",
+    "crud.list_transactions_for_user.history",
+)
+
+
+def grow_archive(ctx, rows, rng):
+    """Add archived loans until the benchmark's archive rows reach `rows`."""
+    archive = models.TransactionArchive.__table__
+    db = SessionLocal()
+    try:
+        existing = db.query(func.count(models.TransactionArchive.id)).filter(
+            models.TransactionArchive.id >= GROWTH_ID_BASE
+        ).scalar()
+        member_ids = [u.id for u in db.query(models.User.id).filter(models.User.username.like("bench_member%"))]
+        book_ids = [b.id for b in db.query(models.Book.id)]
+    finally:
+        db.close()
+
+    today = date.today()
+    for start in range(existing, rows, 50000):
+        batch = []
+        for i in range(start, min(start + 50000, rows)):
+            borrowed = today - timedelta(days=rng.randint(400, 3650))
+            batch.append({
+                "id": GROWTH_ID_BASE + i,
+                "user_id": rng.choice(member_ids),
+                "book_id": rng.choice(book_ids),
+                "borrow_date": borrowed,
+                "due_date": borrowed + timedelta(days=14),
+                "return_date": borrowed + timedelta(days=rng.randint(1, 20)),
+                "status": "returned",
+            })
+        with engine.begin() as conn:
+            conn.execute(archive.insert(), batch)
+
+
+def run_history_growth(args):
+    """Time the hot-path benchmarks while the archive grows to 1x, 10x and 100x the live history."""
+    ensure_dataset()
+    ctx = Context()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = Runner(ctx, loop, args.min_time, args.repeats)
+    benchmarks = dict(BENCHMARKS)
+    base = ctx.dataset["transactions"]
+    rng = random.Random(42)
+
+    results = {name: {} for name in HOT_PATH_BENCHMARKS}
+    try:
+        for factor in HISTORY_GROWTH_FACTORS:
+            grow_archive(ctx, base * factor, rng)
+            print(f"Archive: {base * factor} rows ({factor}x the {base} live transactions)")
+            for name in HOT_PATH_BENCHMARKS:
+                results[name][f"{factor}x"] = runner.run(benchmarks[name])
+            # drop the borrow/return rows so every level starts from the same live table
+            ctx.cleanup()
+    finally:
+        ctx.cleanup()
+        with engine.begin() as conn:
+            conn.execute(
+                models.TransactionArchive.__table__.delete().where(
+                    models.TransactionArchive.id >= GROWTH_ID_BASE,
+                    models.TransactionArchive.user_id.in_(
+                        select(models.User.id).where(models.User.username.like("bench_member%"))
+                    ),
+                )
+            )
+        loop.close()
+
+    print(f"\n{'benchmark (median us)':<44}" + "".join(f"{f'{f}x':>12}" for f in HISTORY_GROWTH_FACTORS) + f"{'growth':>10}")
+    for name, levels in results.items():
+        first = levels[f"{HISTORY_GROWTH_FACTORS[0]}x"]["median_us"]
+        last = levels[f"{HISTORY_GROWTH_FACTORS[-1]}x"]["median_us"]
+        print(
+            f"{name:<44}"
+            + "".join(f"{levels[f'{f}x']['median_us']:>12.1f}" for f in HISTORY_GROWTH_FACTORS)
+            + f"{last / first:>9.2f}x"
+        )
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "database": engine.dialect.name,
+        "dataset": ctx.dataset,
+        "history_growth": results,
+    }
+
+
+def machine():
+    return {"platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(baseline, current, threshold):
+    """Print a comparison and return the names of regressed benchmarks."""
+    if baseline.get("machine") != current.get("machine"):
+        print(
+            f"WARNING: baseline ran on {baseline.get('machine')}, this run on {current.get('machine')}; "
+            "compare SQL counts and allocations, not times"
+        )
+    if baseline["database"] != current["database"] or baseline["dataset"] != current["dataset"]:
+        print(
+            f"WARNING: baseline ran on {baseline['database']} {baseline['dataset']}, "
+            f"this run on {current['database']} {current['dataset']}"
+        )
+    regressions = []
+    print(f"\n{'benchmark':<52} {'time':>22} {'sql':>12} {'peak KiB':>20}")
+    for name, new in current["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if old is None:
+            print(f"{name:<52} {'(new)':>22}")
+            continue
+        time_change = new["median_us"] / old["median_us"] - 1 if old["median_us"] else 0
+        alloc_change = new["alloc_peak_kib"] / old["alloc_peak_kib"] - 1 if old["alloc_peak_kib"] else 0
+        flags = []
+        if time_change > threshold:
+            flags.append("time")
+        if new["sql"] > old["sql"]:
+            flags.append("sql")
+        # ignore noise on tiny allocations
+        if alloc_change > threshold and new["alloc_peak_kib"] - old["alloc_peak_kib"] > 1:
+            flags.append("alloc")
+        if flags:
+            regressions.append(name)
+        print(
+            f"{name:<52} {time_change:>+21.1%} "
+            f"{old['sql']:>5g} -> {new['sql']:<4g} "
+            f"{old['alloc_peak_kib']:>8.1f} -> {new['alloc_peak_kib']:<8.1f}"
+            + (f"  REGRESSION ({', '.join(flags)})" if flags else "")
+        )
+    return regressions
+
+
+def baseline_path(name):
+    return name if name.endswith(".json") else os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LMS API microbenchmarks")
+    parser.add_argument("--filter", action="append", help="only run benchmarks whose name starts with this (repeatable)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timed run")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--save", metavar="NAME", help="store the results as benchmarks/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="compare with benchmarks/NAME.json (or a path)")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regression threshold as a fraction (default 0.2)")
+    parser.add_argument("--list", action="store_true", help="list benchmark names and exit")
+    parser.add_argument("--history-growth", action="store_true",
+                        help="time hot-path queries with 1x, 10x and 100x archived history")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _ in BENCHMARKS:
+            print(name)
+        return
+
+    baseline = None
+    if args.compare:
+        with open(baseline_path(args.compare)) as f:
+            baseline = json.load(f)
+
+    if args.history_growth:
+        result = run_history_growth(args)
+        if args.save:
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            with open(baseline_path(args.save), "w") as f:
+                json.dump(result, f, indent=2)
+        return
+
+    result = run_benchmarks(args)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = baseline_path(args.save)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Baseline written to {path}")
+
+    if baseline is not None:
+        regressions = compare(baseline, result, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) above {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions above {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
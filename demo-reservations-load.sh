@@ -0,0 +1,134 @@
+#!/bin/bash
+# Hot-title load comparison: availability polling vs reservation waitlist
+#
+# Simulates N members waiting for one borrowed book for HOLD_SECONDS.
+#   Before: every member polls GET /books/{id} every POLL_INTERVAL seconds
+#   After:  every member POSTs /reservations once and waits for the
+#           reservation_ready push on /ws/member (no requests while waiting)
+# and prints the number of requests and the request rate for each phase.
+# The first member in line listens on /ws/member; the demo fails if their
+# reservation_ready push does not arrive after the return.
+# Needs curl, jq, bc and python3 with websockets (requirements-dev.txt).
+
+set -e
+
+API_URL="${API_URL:-http://localhost:8000}"
+BOOK_ID="${BOOK_ID:-1}"
+MEMBERS="${MEMBERS:-10}"
+HOLD_SECONDS="${HOLD_SECONDS:-30}"
+POLL_INTERVAL="${POLL_INTERVAL:-1}"
+
+echo "=== Hot-title reservation demo ==="
+echo "API URL: $API_URL"
+echo "Book: $BOOK_ID, waiting members: $MEMBERS, hold: ${HOLD_SECONDS}s, poll interval: ${POLL_INTERVAL}s"
+echo ""
+
+if ! curl -s -f "$API_URL/health" > /dev/null; then
+    echo "ERROR: Cannot reach API at $API_URL"
+    exit 1
+fi
+
+login() {
+    curl -s -X POST "$API_URL/auth/login" \
+        -H "Content-Type: application/x-www-form-urlencoded" \
+        -d "username=$1&password=$2" | jq -r '.access_token'
+}
+
+# member1 holds the book, member2..member(N+1) wait for it (seed.py creates member1-20)
+HOLDER_TOKEN=$(login member1 member123)
+declare -a TOKENS
+for i in $(seq 2 $((MEMBERS + 1))); do
+    TOKENS+=("$(login "member$i" member123)")
+done
+
+borrow() {
+    curl -s -o /dev/null -X POST "$API_URL/borrow" \
+        -H "Authorization: Bearer $HOLDER_TOKEN" -H "Content-Type: application/json" \
+        -d "{\"book_id\": $BOOK_ID}"
+}
+
+give_back() {
+    curl -s -o /dev/null -X POST "$API_URL/return" \
+        -H "Authorization: Bearer $HOLDER_TOKEN" -H "Content-Type: application/json" \
+        -d "{\"book_id\": $BOOK_ID}"
+}
+
+COUNT_DIR=$(mktemp -d)
+trap 'rm -rf "$COUNT_DIR"' EXIT
+
+# ---------- Before: polling ----------
+echo "Phase 1: polling GET /books/$BOOK_ID ..."
+borrow
+END=$((SECONDS + HOLD_SECONDS))
+for i in "${!TOKENS[@]}"; do
+    (
+        n=0
+        while [ $SECONDS -lt $END ]; do
+            curl -s -o /dev/null "$API_URL/books/$BOOK_ID"
+            n=$((n + 1))
+            sleep "$POLL_INTERVAL"
+        done
+        echo $n > "$COUNT_DIR/poll-$i"
+    ) &
+done
+wait
+give_back
+POLL_REQUESTS=$(cat "$COUNT_DIR"/poll-* | paste -sd+ - | bc)
+
+# ---------- After: reservations + push ----------
+echo "Phase 2: POST /reservations once per member ..."
+borrow
+# the first member in line waits for their push
+WS_URL="${API_URL/http/ws}/ws/member?token=${TOKENS[0]}"
+PUSH_TIMEOUT=$((HOLD_SECONDS + 30))
+python3 - "$WS_URL" "$BOOK_ID" "$PUSH_TIMEOUT" > "$COUNT_DIR/push" <<'PY' &
+import asyncio, json, sys
+import websockets
+
+async def main(url, book_id, timeout):
+    async with websockets.connect(url) as ws:
+        while True:
+            event = json.loads(await ws.recv())
+            if event.get("event") == "reservation_ready" and event.get("book_id") == book_id:
+                print(json.dumps(event))
+                return
+
+try:
+    asyncio.run(asyncio.wait_for(main(sys.argv[1], int(sys.argv[2]), float(sys.argv[3])), float(sys.argv[3])))
+except Exception as exc:
+    print(f"no push: {exc!r}", file=sys.stderr)
+    sys.exit(1)
+PY
+LISTENER=$!
+sleep 1
+RES_REQUESTS=0
+for t in "${TOKENS[@]}"; do
+    curl -s -o /dev/null -X POST "$API_URL/reservations" \
+        -H "Authorization: Bearer $t" -H "Content-Type: application/json" \
+        -d "{\"book_id\": $BOOK_ID}"
+    RES_REQUESTS=$((RES_REQUESTS + 1))
+done
+sleep "$HOLD_SECONDS"
+give_back
+if wait "$LISTENER"; then
+    PUSH="delivered: $(cat "$COUNT_DIR/push")"
+else
+    echo "ERROR: member2 did not receive reservation_ready on /ws/member"
+    exit 1
+fi
+
+# clean up the waitlist so the demo can be re-run
+for t in "${TOKENS[@]}"; do
+    for rid in $(curl -s "$API_URL/reservations" -H "Authorization: Bearer $t" | jq -r ".[] | select(.book_id == $BOOK_ID) | .id"); do
+        curl -s -o /dev/null -X DELETE "$API_URL/reservations/$rid" -H "Authorization: Bearer $t"
+    done
+done
+
+echo ""
+echo "=== Results (waiting members only) ==="
+printf "%-28s %10s %12s\n" "Mode" "Requests" "Req/s"
+printf "%-28s %10s %12s\n" "Polling /books/{id}" "$POLL_REQUESTS" "$(echo "scale=2; $POLL_REQUESTS / $HOLD_SECONDS" | bc)"
+printf "%-28s %10s %12s\n" "Reservations + WS push" "$RES_REQUESTS" "$(echo "scale=2; $RES_REQUESTS / $HOLD_SECONDS" | bc)"
+echo ""
+echo "reservation_ready push to the first member in line $PUSH"
+echo "Pushes sent are counted in lms_reservation_notifications_total on /metrics"
@@ -62,6 +62,14 @@ kubectl apply -f deployment.yaml
 echo "🌐 Creating Service..."
 kubectl apply -f service.yaml
 
+# Nightly archival of closed loans (app/archive.py)
+echo "🗄️  Scheduling transaction archival..."
+kubectl apply -f cronjob-archive.yaml
+
+# Nightly compaction of the analytics rollups (app/analytics.py)
+echo "📊 Scheduling analytics compaction..."
+kubectl apply -f cronjob-analytics.yaml
+
 # Step 6: Wait for API to be ready
 echo "⏳ Waiting for API to be ready..."
 kubectl wait --for=condition=available deployment/lms-api --timeout=300s || {
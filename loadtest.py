@@ -0,0 +1,391 @@
+"""
+Asyncio load generator for the LMS API.
+
+Scenarios (mixed by weight with --mix):
+    browse  GET /books/, GET /books/{id}, GET /books/available
+    churn   POST /borrow and POST /return across many member tokens
+    admin   GET /admin/transactions with different filters
+plus optional /ws/admin subscribers that measure how long a borrow/return
+takes to reach them as a book_update.
+
+Modes:
+    open    constant arrival rate (--rate requests/s), latency measured from
+            the scheduled start so queueing in the server is not hidden
+    closed  --concurrency workers each sending the next request as soon as
+            the previous one finishes
+
+Example, against a local uvicorn + Postgres seeded with seed.py:
+    python loadtest.py --base-url http://localhost:8000 --mode open --rate 100 \
+        --duration 60 --ws-active 10 --ws-idle 200 --output run.json
+    python loadtest.py --compare before.json after.json
+
+List endpoints are rate limited per client by the admission controller, so
+set LIST_RATE_PER_SECOND high (or ADMISSION_ENABLED=false) on the server when
+you want to measure raw capacity; 429/503 responses are reported separately
+as "shed".
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+try:
+    import httpx
+    import websockets
+except ImportError:
+    print("loadtest.py needs httpx and websockets: pip install -r requirements-dev.txt")
+    sys.exit(1)
+
+DEFAULT_MIX = "browse=70,churn=20,admin=10"
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "p50_ms": round(percentile(values, 50) * 1000, 3),
+        "p95_ms": round(percentile(values, 95) * 1000, 3),
+        "p99_ms": round(percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.client_errors = defaultdict(int)
+        self.rate_limited = defaultdict(int)
+        self.shed = defaultdict(int)
+        self.status_codes = defaultdict(int)
+        self.ws_latencies = []
+        self.ws_events = 0
+
+    def record(self, operation, seconds, status=None, error=None):
+        """Only 2xx responses count as successes and go into the latency percentiles."""
+        if error is not None:
+            self.errors[f"{operation}: {error}"] += 1
+            return
+        self.status_codes[str(status)] += 1
+        if 200 <= status < 300:
+            self.latencies[operation].append(seconds)
+        elif status == 429:
+            self.rate_limited[operation] += 1
+        elif status == 503:
+            self.shed[operation] += 1
+        elif 400 <= status < 500:
+            self.client_errors[operation] += 1
+        else:
+            self.errors[f"{operation}: HTTP {status}"] += 1
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.member_tokens = []
+        self.admin_token = None
+        self.book_ids = []
+        self.genres = []
+        # member index -> book ids that member currently holds
+        self.borrowed = defaultdict(set)
+        # (book_id, available) -> time the borrow/return was sent
+        self.pending_ws = {}
+        self.scenarios = self.parse_mix(args.mix)
+
+    @staticmethod
+    def parse_mix(mix):
+        scenarios = []
+        for part in mix.split(","):
+            name, weight = part.split("=")
+            if name not in ("browse", "churn", "admin"):
+                raise SystemExit(f"Unknown scenario {name!r}")
+            scenarios.append((name, float(weight)))
+        return scenarios
+
+    async def setup(self, client):
+        # /auth/login admits LOGIN_MAX_CONCURRENCY + LOGIN_MAX_QUEUE logins per pod
+        # and answers the rest with 503 + Retry-After, so log in a few at a time
+        # and wait out a 503 instead of aborting the run
+        limit = asyncio.Semaphore(self.args.login_concurrency)
+
+        async def login(username, password):
+            async with limit:
+                for attempt in range(self.args.login_retries + 1):
+                    r = await client.post("/auth/login", data={"username": username, "password": password})
+                    if r.status_code != 503 or attempt == self.args.login_retries:
+                        break
+                    await asyncio.sleep(float(r.headers.get("retry-after", "1")) * (1 + random.random()))
+            r.raise_for_status()
+            return r.json()["access_token"]
+
+        self.admin_token = await login(self.args.admin_user, self.args.admin_password)
+        self.member_tokens = await asyncio.gather(
+            *(login(f"{self.args.member_prefix}{i}", self.args.member_password) for i in range(1, self.args.members + 1))
+        )
+        books = (await client.get("/books/")).json()
+        self.book_ids = [b["id"] for b in books]
+        self.genres = sorted({b["genre"] for b in books if b.get("genre")})
+        if not self.book_ids:
+            raise SystemExit("No books found, run seed.py first")
+        print(f"Logged in {len(self.member_tokens)} members, {len(self.book_ids)} books")
+
+    # ---------- scenarios ----------
+
+    async def timed(self, client, operation, method, url, scheduled, **kwargs):
+        try:
+            r = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as exc:
+            self.stats.record(operation, 0, error=type(exc).__name__)
+            return None
+        self.stats.record(operation, time.perf_counter() - scheduled, status=r.status_code)
+        return r
+
+    async def browse(self, client, scheduled):
+        choice = random.random()
+        if choice < 0.2:
+            await self.timed(client, "GET /books/", "GET", "/books/", scheduled)
+        elif choice < 0.8:
+            book_id = random.choice(self.book_ids)
+            await self.timed(client, "GET /books/{id}", "GET", f"/books/{book_id}", scheduled)
+        else:
+            params = {"genre": random.choice(self.genres)} if self.genres else {}
+            await self.timed(client, "GET /books/available", "GET", "/books/available", scheduled, params=params)
+
+    async def churn(self, client, scheduled):
+        member = random.randrange(len(self.member_tokens))
+        headers = {"Authorization": f"Bearer {self.member_tokens[member]}"}
+        held = self.borrowed[member]
+        if held and (random.random() < 0.5 or len(held) >= 5):
+            book_id = random.choice(tuple(held))
+            self.pending_ws[(book_id, True)] = time.perf_counter()
+            r = await self.timed(client, "POST /return", "POST", "/return", scheduled,
+                                 json={"book_id": book_id}, headers=headers)
+            if r is not None and r.status_code == 200:
+                held.discard(book_id)
+        else:
+            book_id = random.choice(self.book_ids)
+            self.pending_ws[(book_id, False)] = time.perf_counter()
+            r = await self.timed(client, "POST /borrow", "POST", "/borrow", scheduled,
+                                 json={"book_id": book_id}, headers=headers)
+            if r is not None and r.status_code == 200:
+                held.add(book_id)
+
+    async def admin(self, client, scheduled):
+        headers = {"Authorization": f"Bearer {self.admin_token}"}
+        params = random.choice([{}, {"status": "borrowed"}, {"unreturned_only": "true"}, {"status": "overdue"}])
+        await self.timed(client, "GET /admin/transactions", "GET", "/admin/transactions", scheduled,
+                         params=params, headers=headers)
+
+    async def run_one(self, client, scheduled):
+        name = random.choices([s[0] for s in self.scenarios], weights=[s[1] for s in self.scenarios])[0]
+        await getattr(self, name)(client, scheduled)
+
+    # ---------- WebSocket subscribers ----------
+
+    async def ws_subscriber(self, active, stop):
+        url = self.args.base_url.replace("http", "ws", 1) + f"/ws/admin?token={self.admin_token}"
+        try:
+            async with websockets.connect(url, max_queue=None) as ws:
+                while not stop.is_set():
+                    try:
+                        text = await asyncio.wait_for(ws.recv(), timeout=1)
+                    except asyncio.TimeoutError:
+                        continue
+                    if not active:
+                        continue
+                    received = time.perf_counter()
+                    message = json.loads(text)
+                    updates = message.get("updates", [message])
+                    for update in updates:
+                        if update.get("event") != "book_update":
+                            continue
+                        self.stats.ws_events += 1
+                        sent = self.pending_ws.get((update["book_id"], update["available"]))
+                        if sent is not None:
+                            self.stats.ws_latencies.append(received - sent)
+        except Exception as exc:
+            self.stats.errors[f"ws: {type(exc).__name__}"] += 1
+
+    # ---------- drivers ----------
+
+    async def open_loop(self, client, deadline):
+        interval = 1 / self.args.rate
+        tasks = set()
+        next_at = time.perf_counter()
+        while next_at < deadline:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(self.run_one(client, next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += interval
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def closed_loop(self, client, deadline):
+        async def worker():
+            while time.perf_counter() < deadline:
+                await self.run_one(client, time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def run(self):
+        limits = httpx.Limits(max_connections=self.args.max_connections, max_keepalive_connections=self.args.max_connections)
+        async with httpx.AsyncClient(base_url=self.args.base_url, limits=limits, timeout=self.args.timeout) as client:
+            await self.setup(client)
+
+            stop = asyncio.Event()
+            subscribers = [asyncio.create_task(self.ws_subscriber(True, stop)) for _ in range(self.args.ws_active)]
+            subscribers += [asyncio.create_task(self.ws_subscriber(False, stop)) for _ in range(self.args.ws_idle)]
+            if subscribers:
+                await asyncio.sleep(1)
+
+            started = time.perf_counter()
+            deadline = started + self.args.duration
+            if self.args.mode == "open":
+                await self.open_loop(client, deadline)
+            else:
+                await self.closed_loop(client, deadline)
+            elapsed = time.perf_counter() - started
+
+            # give the last broadcasts time to arrive
+            await asyncio.sleep(0.5)
+            stop.set()
+            await asyncio.gather(*subscribers)
+
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        stats = self.stats
+        ok = sum(len(v) for v in stats.latencies.values())
+        errors = sum(stats.errors.values())
+        client_errors = sum(stats.client_errors.values())
+        rate_limited = sum(stats.rate_limited.values())
+        shed = sum(stats.shed.values())
+        all_latencies = [v for values in stats.latencies.values() for v in values]
+        return {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "config": {k: v for k, v in vars(self.args).items() if k not in ("output", "compare")},
+            "duration_seconds": round(elapsed, 3),
+            "totals": {
+                "requests": ok + client_errors + rate_limited + shed + errors,
+                "ok": ok,
+                "client_errors": client_errors,
+                "rate_limited": rate_limited,
+                "shed": shed,
+                "errors": errors,
+                "throughput_rps": round(ok / elapsed, 2) if elapsed else 0,
+                "latency": latency_summary(all_latencies),
+            },
+            "operations": {
+                name: dict(
+                    latency_summary(stats.latencies.get(name, [])),
+                    client_errors=stats.client_errors.get(name, 0),
+                    rate_limited=stats.rate_limited.get(name, 0),
+                    shed=stats.shed.get(name, 0),
+                )
+                for name in sorted(
+                    set(stats.latencies) | set(stats.client_errors) | set(stats.rate_limited) | set(stats.shed)
+                )
+            },
+            "status_codes": dict(stats.status_codes),
+            "errors": dict(stats.errors),
+            "websocket": {
+                "active_subscribers": self.args.ws_active,
+                "idle_subscribers": self.args.ws_idle,
+                "events_received": stats.ws_events,
+                "delivery_latency": latency_summary(stats.ws_latencies),
+            },
+        }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'operation':<28} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18}")
+    rows = [("total", before["totals"]["latency"], after["totals"]["latency"])]
+    for name in sorted(set(before["operations"]) | set(after["operations"])):
+        rows.append((name, before["operations"].get(name, {}), after["operations"].get(name, {})))
+    rows.append(("ws delivery", before["websocket"]["delivery_latency"], after["websocket"]["delivery_latency"]))
+    for name, b, a in rows:
+        cells = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if key in b and key in a:
+                cells.append(f"{b[key]:>7} -> {a[key]:<7}")
+            else:
+                cells.append(f"{'-':>18}")
+        print(f"{name:<28} " + " ".join(f"{c:>18}" for c in cells))
+    for key in ("client_errors", "rate_limited", "shed", "errors"):
+        label = key.replace("_", " ")
+        print(f"{label:<28} {before['totals'].get(key, 0):>7} -> {after['totals'].get(key, 0)}")
+    print(f"{'throughput rps':<28} {before['totals']['throughput_rps']:>7} -> {after['totals']['throughput_rps']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LMS API load generator")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--rate", type=float, default=50, help="open mode: requests per second")
+    parser.add_argument("--concurrency", type=int, default=20, help="closed mode: number of workers")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"scenario weights (default {DEFAULT_MIX})")
+    parser.add_argument("--members", type=int, default=20, help="member accounts to log in (seed.py creates 20)")
+    parser.add_argument("--member-prefix", default="member")
+    parser.add_argument("--login-concurrency", type=int, default=8, help="logins in flight during setup")
+    parser.add_argument("--login-retries", type=int, default=10, help="retries of a login answered with 503")
+    parser.add_argument("--member-password", default="member123")
+    parser.add_argument("--admin-user", default="admin1")
+    parser.add_argument("--admin-password", default="admin123")
+    parser.add_argument("--ws-active", type=int, default=0, help="/ws/admin subscribers measuring delivery latency")
+    parser.add_argument("--ws-idle", type=int, default=0, help="/ws/admin subscribers that only hold the connection")
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a repeatable request mix")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two JSON reports")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    result = asyncio.run(LoadTest(args).run())
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+        print(f"Report written to {args.output}")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,3 +35,41 @@ CREATE TABLE IF NOT EXISTS reservations (
     reserved_date DATE NOT NULL DEFAULT CURRENT_DATE,
     notified_at TIMESTAMPTZ
 );
+
+-- FIFO waitlist lookups: next reservation for a book in id order
+CREATE INDEX IF NOT EXISTS idx_reservations_book_id ON reservations (book_id, id);
+
+-- Hot-path lookups on the (small) live transactions table
+CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions (user_id, borrow_date);
+CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions (status, return_date);
+
+-- Closed loans older than TRANSACTION_ARCHIVE_DAYS, moved here by app/archive.py.
+-- Monthly partitions on borrow_date are created by the archive job as needed.
+CREATE TABLE IF NOT EXISTS transactions_archive (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    borrow_date DATE NOT NULL,
+    due_date DATE NOT NULL,
+    return_date DATE,
+    status VARCHAR(20) NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (id, borrow_date)
+) PARTITION BY RANGE (borrow_date);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_archive_user_id ON transactions_archive (user_id, borrow_date);
+
+-- Loan counters per day (per month once compacted) for /admin/analytics,
+-- kept up to date by borrow/return and compacted nightly by app/analytics.py.
+CREATE TABLE IF NOT EXISTS loan_rollups (
+    dimension VARCHAR(10) NOT NULL CHECK (dimension IN ('all', 'genre', 'author', 'book', 'member')),
+    period VARCHAR(5) NOT NULL CHECK (period IN ('day', 'month')),
+    period_start DATE NOT NULL,
+    key TEXT NOT NULL,
+    shard SMALLINT NOT NULL DEFAULT 0,
+    loans INTEGER NOT NULL DEFAULT 0,
+    returns INTEGER NOT NULL DEFAULT 0,
+    overdue_returns INTEGER NOT NULL DEFAULT 0,
+    loan_days BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, period, period_start, key, shard)
+);
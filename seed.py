@@ -1,8 +1,33 @@
+"""
+Seed the database.
+
+    python seed.py            demo data: admin1, member1-20, 100 books
+    python seed.py --scale    synthetic data for scale testing, by default
+                              1M books, 200k users and 20M transactions
+
+Scale mode generates rows in chunks in parallel worker processes and loads
+each chunk with COPY (PostgreSQL) or executemany (other databases, one
+worker). Popular titles and heavy borrowers follow Zipf distributions and
+borrow dates follow a seasonal curve. Each chunk has its own random
+generator derived from --seed, so the same seed, sizes and chunk size on an
+empty database always produce the same rows.
+
+All options can also be set with SEED_* environment variables, which is how
+k8s/job-seed.yaml switches modes.
+"""
+import argparse
+import io
+import itertools
+import multiprocessing
+import os
 import random
-from datetime import date, timedelta
+import time
+from datetime import date, datetime, timedelta
 
-from app.db import SessionLocal
-from app import models, auth
+from sqlalchemy import func, text
+
+from app.db import SessionLocal, engine
+from app import analytics, models, auth
 
 
 def ensure_admin(db):
@@ -150,7 +175,318 @@ def seed_transactions(db, members, books):
     print(f"Created {tx_count} transactions with mixed statuses (returned, overdue, borrowed).")
 
 
+# ------------- Scale mode -------------
+
+# Relative borrowing activity per month (academic year peaks, summer and December dips)
+MONTH_WEIGHTS = {1: 1.1, 2: 1.15, 3: 1.1, 4: 1.0, 5: 0.9, 6: 0.7, 7: 0.65, 8: 0.8, 9: 1.3, 10: 1.25, 11: 1.15, 12: 0.75}
+# Monday..Sunday
+WEEKDAY_WEIGHTS = (1.0, 1.0, 1.0, 1.0, 0.9, 0.7, 0.5)
+
+SCALE_GENRES = ["Fiction", "Non-Fiction", "Science", "History", "Programming", "Fantasy",
+                "Mystery", "Biography", "Children", "Poetry", "Travel", "Cooking"]
+# share of books per genre, same order as SCALE_GENRES
+SCALE_GENRE_WEIGHTS = [22, 14, 9, 8, 6, 10, 9, 6, 7, 3, 3, 3]
+TITLE_ADJECTIVES = ["Silent", "Hidden", "Last", "Broken", "Golden", "Distant", "Forgotten", "Endless",
+                    "Crimson", "Quiet", "Lost", "Burning", "Secret", "Wild", "Winter", "Northern"]
+TITLE_NOUNS = ["River", "Garden", "Empire", "Algorithm", "Kingdom", "Letters", "Machine", "Ocean",
+               "Mountain", "Library", "Theory", "Voyage", "Storm", "Archive", "Harbor", "Forest"]
+FIRST_NAMES = ["Ada", "Alan", "Grace", "Linus", "Maya", "Omar", "Priya", "Chen", "Sofia", "Kwame",
+               "Elena", "Hiro", "Noor", "Lucas", "Amara", "Ivan"]
+LAST_NAMES = ["Lovelace", "Turing", "Hopper", "Okafor", "Nakamura", "Silva", "Haddad", "Novak",
+              "Kowalski", "Mensah", "Larsen", "Duarte", "Ibrahim", "Petrov", "Moreau", "Sato"]
+
+BOOK_COLUMNS = ("id", "title", "author", "isbn", "genre", "available", "shelf_location", "created_at")
+USER_COLUMNS = ("id", "username", "password_hash", "role", "created_at")
+TRANSACTION_COLUMNS = ("id", "user_id", "book_id", "borrow_date", "due_date", "return_date", "status")
+
+LOAN_DAYS = 14
+
+
+def cumulative_zipf(n, s):
+    """Cumulative weights of a Zipf distribution over ranks 0..n-1, for random.choices()."""
+    return list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(n)))
+
+
+class ScalePlan:
+    """Sizes, id offsets and shared distributions. Pickled into every worker."""
+
+    def __init__(self, args, user_base, book_base, tx_base, password_hash):
+        self.seed = args.seed
+        self.users = args.users
+        self.books = args.books
+        self.transactions = args.transactions
+        self.history_days = args.history_days
+        self.book_skew = args.book_skew
+        self.user_skew = args.user_skew
+        self.active_loan_fraction = args.active_loan_fraction
+        self.user_base = user_base
+        self.book_base = book_base
+        self.tx_base = tx_base
+        # active loans get ids after the history, one slot per book
+        self.active_tx_base = tx_base + args.transactions
+        self.password_hash = password_hash
+        self.today = date.today()
+        self.created_at = datetime.utcnow().replace(microsecond=0)
+
+    def rng(self, table, chunk):
+        return random.Random(f"{self.seed}:{table}:{chunk}")
+
+
+# Built once per worker process; cumulative weights for millions of ranks are
+# too large to send with every task
+_distributions = {}
+
+
+def distributions(plan):
+    if not _distributions:
+        # history ends LOAN_DAYS + 21 days ago so every historical loan is returned by today
+        last = plan.today - timedelta(days=LOAN_DAYS + 21)
+        days = [last - timedelta(days=n) for n in range(plan.history_days)]
+        _distributions["days"] = days
+        _distributions["day_weights"] = list(itertools.accumulate(
+            MONTH_WEIGHTS[d.month] * WEEKDAY_WEIGHTS[d.weekday()] for d in days
+        ))
+        _distributions["books"] = cumulative_zipf(plan.books, plan.book_skew)
+        _distributions["users"] = cumulative_zipf(plan.users, plan.user_skew)
+        _distributions["genres"] = list(itertools.accumulate(SCALE_GENRE_WEIGHTS))
+        # mean Zipf weight, to turn a book's weight into an on-loan probability
+        _distributions["mean_book_weight"] = _distributions["books"][-1] / plan.books
+    return _distributions
+
+
+def generate_users(plan, chunk, start, end):
+    for i in range(start, end):
+        yield (plan.user_base + i + 1, f"user{i + 1}", plan.password_hash, "member", plan.created_at)
+
+
+def generate_books(plan, chunk, start, end):
+    """Books for ranks start..end-1 (rank 0 is the most popular), plus their active loans."""
+    rng = plan.rng("books", chunk)
+    dist = distributions(plan)
+    cum_books = dist["books"]
+    books = []
+    loans = []
+    genres = rng.choices(SCALE_GENRES, cum_weights=dist["genres"], k=end - start)
+    for offset, rank in enumerate(range(start, end)):
+        book_id = plan.book_base + rank + 1
+        weight = cum_books[rank] - (cum_books[rank - 1] if rank else 0)
+        on_loan = rng.random() < min(0.9, plan.active_loan_fraction * weight / dist["mean_book_weight"])
+        author_rank = min(int(rng.paretovariate(1.2)) - 1, 5000)
+        books.append((
+            book_id,
+            f"The {rng.choice(TITLE_ADJECTIVES)} {rng.choice(TITLE_NOUNS)} {rank % 97 + 1}",
+            f"{FIRST_NAMES[author_rank % len(FIRST_NAMES)]} {LAST_NAMES[(author_rank // len(FIRST_NAMES)) % len(LAST_NAMES)]}"
+            + (f" {author_rank // 256 + 1}" if author_rank >= 256 else ""),
+            f"SCALE-{rank + 1:010d}",
+            genres[offset],
+            not on_loan,
+            f"Shelf-{rank % 200 + 1}",
+            plan.created_at,
+        ))
+        if on_loan:
+            borrow_date = plan.today - timedelta(days=rng.randint(0, LOAN_DAYS + 14))
+            loans.append((
+                plan.active_tx_base + rank + 1,
+                plan.user_base + rng.choices(range(plan.users), cum_weights=dist["users"])[0] + 1,
+                book_id,
+                borrow_date,
+                borrow_date + timedelta(days=LOAN_DAYS),
+                None,
+                "borrowed",
+            ))
+    return books, loans
+
+
+def generate_transactions(plan, chunk, start, end):
+    """Returned (on time or overdue) loans; books and borrowers Zipf-skewed, dates seasonal."""
+    rng = plan.rng("transactions", chunk)
+    dist = distributions(plan)
+    count = end - start
+    book_ranks = rng.choices(range(plan.books), cum_weights=dist["books"], k=count)
+    user_ranks = rng.choices(range(plan.users), cum_weights=dist["users"], k=count)
+    days = rng.choices(dist["days"], cum_weights=dist["day_weights"], k=count)
+    for i in range(count):
+        borrow_date = days[i]
+        due_date = borrow_date + timedelta(days=LOAN_DAYS)
+        # about 80% come back on time, the rest up to three weeks late
+        if rng.random() < 0.8:
+            return_date = borrow_date + timedelta(days=rng.randint(1, LOAN_DAYS))
+            status = "returned"
+        else:
+            return_date = due_date + timedelta(days=rng.randint(1, 21))
+            status = "overdue"
+        yield (
+            plan.tx_base + start + i + 1,
+            plan.user_base + user_ranks[i] + 1,
+            plan.book_base + book_ranks[i] + 1,
+            borrow_date,
+            due_date,
+            return_date,
+            status,
+        )
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if value is True:
+        return "t"
+    if value is False:
+        return "f"
+    return str(value)
+
+
+def load_rows(table, columns, rows):
+    """Load rows with COPY on PostgreSQL, executemany elsewhere. Returns the row count."""
+    rows = list(rows)
+    if not rows:
+        return 0
+    if engine.dialect.name == "postgresql":
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write("\t".join(copy_value(v) for v in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+            raw.commit()
+        finally:
+            raw.close()
+    else:
+        placeholders = ", ".join(f":{c}" for c in columns)
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"),
+                [dict(zip(columns, row)) for row in rows],
+            )
+    return len(rows)
+
+
+def load_chunk(task):
+    kind, plan, chunk, start, end = task
+    if kind == "users":
+        return kind, load_rows("users", USER_COLUMNS, generate_users(plan, chunk, start, end))
+    if kind == "books":
+        books, loans = generate_books(plan, chunk, start, end)
+        count = load_rows("books", BOOK_COLUMNS, books)
+        load_rows("transactions", TRANSACTION_COLUMNS, loans)
+        return kind, count
+    return kind, load_rows("transactions", TRANSACTION_COLUMNS, generate_transactions(plan, chunk, start, end))
+
+
+def init_worker():
+    # connections inherited from the parent process must not be shared
+    engine.dispose(close=False)
+
+
+def run_phase(pool, kind, plan, total, chunk_size):
+    tasks = [
+        (kind, plan, chunk, start, min(start + chunk_size, total))
+        for chunk, start in enumerate(range(0, total, chunk_size))
+    ]
+    started = time.perf_counter()
+    loaded = 0
+    results = pool.imap_unordered(load_chunk, tasks) if pool else map(load_chunk, tasks)
+    for _, count in results:
+        loaded += count
+        elapsed = time.perf_counter() - started
+        print(f"  {kind}: {loaded:,}/{total:,} rows ({loaded / elapsed:,.0f} rows/s)", flush=True)
+    return loaded
+
+
+def reset_sequences(db):
+    if engine.dialect.name != "postgresql":
+        return
+    for table in ("users", "books", "transactions"):
+        db.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 1))"
+        ))
+    db.commit()
+
+
+def seed_scale(args):
+    db = SessionLocal()
+    try:
+        ensure_admin(db)
+        if db.query(models.Book).filter(models.Book.isbn.like("SCALE-%")).first() is not None:
+            print("Scale data already loaded (books with SCALE- ISBNs exist), skipping.")
+            return
+        user_base = db.query(func.max(models.User.id)).scalar() or 0
+        book_base = db.query(func.max(models.Book.id)).scalar() or 0
+        tx_base = db.query(func.max(models.Transaction.id)).scalar() or 0
+    finally:
+        db.close()
+
+    # one hash for every generated member: bcrypt for millions of users would take days
+    plan = ScalePlan(args, user_base, book_base, tx_base, auth.get_password_hash("member123"))
+    workers = args.workers if engine.dialect.name == "postgresql" else 1
+    print(
+        f"Scale seed: {args.users:,} users, {args.books:,} books, {args.transactions:,} transactions, "
+        f"seed {args.seed}, {workers} workers, chunks of {args.chunk_size:,}"
+    )
+
+    started = time.perf_counter()
+    pool = multiprocessing.Pool(workers, initializer=init_worker) if workers > 1 else None
+    try:
+        total = 0
+        # users and books before transactions, which reference both
+        total += run_phase(pool, "users", plan, args.users, args.chunk_size)
+        total += run_phase(pool, "books", plan, args.books, args.chunk_size)
+        total += run_phase(pool, "transactions", plan, args.transactions, args.chunk_size)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    db = SessionLocal()
+    try:
+        reset_sequences(db)
+        active = db.query(models.Transaction).filter(models.Transaction.status == "borrowed").count()
+        # the rows were loaded without crud, so the analytics counters are built from them
+        rollup_started = time.perf_counter()
+        analytics.rebuild(db)
+        print(f"Rebuilt analytics rollups in {time.perf_counter() - rollup_started:.1f}s")
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {total:,} rows (+{active:,} active loans in total) in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+    print("Generated members log in as user1..userN with password 'member123'.")
+
+
+def parse_args():
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Seed the LMS database")
+    parser.add_argument("--scale", action="store_true", default=env("SEED_MODE", "demo") == "scale",
+                        help="generate synthetic data for scale testing (SEED_MODE=scale)")
+    parser.add_argument("--books", type=int, default=int(env("SEED_BOOKS", "1000000")))
+    parser.add_argument("--users", type=int, default=int(env("SEED_USERS", "200000")))
+    parser.add_argument("--transactions", type=int, default=int(env("SEED_TRANSACTIONS", "20000000")))
+    parser.add_argument("--seed", type=int, default=int(env("SEED_RANDOM_SEED", "42")),
+                        help="random seed; same seed and sizes give the same data")
+    parser.add_argument("--workers", type=int, default=int(env("SEED_WORKERS", str(os.cpu_count() or 1))),
+                        help="parallel loader processes (PostgreSQL only)")
+    parser.add_argument("--chunk-size", type=int, default=int(env("SEED_CHUNK_SIZE", "100000")),
+                        help="rows per COPY; part of what makes a run deterministic")
+    parser.add_argument("--history-days", type=int, default=int(env("SEED_HISTORY_DAYS", "1095")),
+                        help="how far back transaction history goes")
+    parser.add_argument("--book-skew", type=float, default=float(env("SEED_BOOK_SKEW", "1.0")),
+                        help="Zipf exponent for title popularity")
+    parser.add_argument("--user-skew", type=float, default=float(env("SEED_USER_SKEW", "0.8")),
+                        help="Zipf exponent for borrower activity")
+    parser.add_argument("--active-loan-fraction", type=float, default=float(env("SEED_ACTIVE_LOAN_FRACTION", "0.05")),
+                        help="roughly the share of books currently on loan")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    if args.scale:
+        seed_scale(args)
+        return
+
     db = SessionLocal()
     try:
         print("Seeding database...")
@@ -159,6 +495,7 @@ def main():
         members = ensure_members(db, count=20)
         books = ensure_books(db, count=100)
         seed_transactions(db, members, books)
+        analytics.rebuild(db)
 
         print("Seeding complete.")
     finally: